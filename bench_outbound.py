@@ -0,0 +1,142 @@
+"""
+Прогон OutboundLimiter без Telegram: фейковая сессия отвечает мгновенно и считает запросы.
+
+    python bench_outbound.py
+
+Сценарии: всплеск отправок в несколько чатов, пачка правок одного сообщения (должна схлопнуться),
+правки разных сообщений в группе (не должны ждать лимит группы), «хэндлер», который шлёт правки
+без ожидания, флуд в одну группу сверх SEND_CHAT_QUEUE_MAX и 429 с retry_after на первом запросе.
+"""
+import asyncio
+import json
+import os
+import time
+
+os.environ.setdefault("BOT_TOKEN", "1:bench")
+# лимиты поменьше, чтобы прогон шёл секунды
+os.environ.setdefault("SEND_GLOBAL_RATE", "20")
+os.environ.setdefault("SEND_GROUP_PER_MIN", "120")
+
+from aiogram import Bot  # noqa: E402
+from aiogram.client.session.base import BaseSession  # noqa: E402
+from aiogram.methods import EditMessageText, SendMessage  # noqa: E402
+
+from pointsbot import METRICS, SEND_CHAT_QUEUE_MAX, OutboundLimiter, OutboundQueueFull  # noqa: E402
+
+
+class FakeSession(BaseSession):
+    def __init__(self, fail_first_with_retry_after: int = 0):
+        super().__init__()
+        self.calls = []
+        self.retry_after = fail_first_with_retry_after
+
+    async def make_request(self, bot, method, timeout=None):
+        self.calls.append((time.monotonic(), type(method).__name__, getattr(method, "chat_id", None)))
+        if self.retry_after:
+            content = {
+                "ok": False,
+                "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            }
+            self.retry_after = 0
+            return self.check_response(bot, method, 429, json.dumps(content)).result
+
+        chat_id = getattr(method, "chat_id", 0)
+        result = {
+            "message_id": getattr(method, "message_id", None) or len(self.calls),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "supergroup" if chat_id < 0 else "private"},
+            "text": getattr(method, "text", ""),
+        }
+        return self.check_response(bot, method, 200, json.dumps({"ok": True, "result": result})).result
+
+    async def close(self):
+        pass
+
+    async def stream_content(self, *args, **kwargs):
+        raise NotImplementedError
+        yield b""
+
+
+def make_bot(**kwargs):
+    session = FakeSession(**kwargs)
+    limiter = OutboundLimiter()
+    session.middleware(limiter)
+    return Bot("1:bench", session=session), session, limiter
+
+
+async def burst():
+    bot, session, _ = make_bot()
+    chats = [-1001, -1002, -1003] + list(range(1, 11))
+    started = time.monotonic()
+    await asyncio.gather(*[bot.send_message(c, f"msg {i}") for i in range(5) for c in chats])
+    elapsed = time.monotonic() - started
+    print(f"burst: {len(session.calls)} sends into {len(chats)} chats in {elapsed:.2f}s")
+
+
+async def edits():
+    bot, session, _ = make_bot()
+    results = await asyncio.gather(*[
+        bot.edit_message_text(f"страница {i}", chat_id=-1001, message_id=7) for i in range(20)
+    ])
+    texts = {r.text for r in results}
+    print(f"edits: 20 calls -> {len(session.calls)} requests, callers saw {sorted(texts)}")
+
+
+async def group_edits():
+    # кнопки меню/топа в группе: правки разных сообщений идут мимо лимита 20 в минуту
+    bot, session, _ = make_bot()
+    started = time.monotonic()
+    await asyncio.gather(*[
+        bot.edit_message_text(f"меню {i}", chat_id=-1001, message_id=100 + i) for i in range(6)
+    ])
+    print(f"group edits: 6 messages edited in {time.monotonic() - started:.2f}s")
+
+
+async def flood():
+    bot, session, limiter = make_bot()
+    futures = [
+        limiter.submit(session.make_request, bot, SendMessage(chat_id=-1003, text=f"топ {i}"))
+        for i in range(SEND_CHAT_QUEUE_MAX + 10)
+    ]
+    dropped = sum(isinstance(f.exception(), OutboundQueueFull) for f in futures if f.done())
+    # не ждём минуту разбора очереди: гасим воркер, он сам отменит оставшееся
+    await asyncio.sleep(0.1)
+    limiter.outboxes[-1003].worker.cancel()
+    await asyncio.gather(*futures, return_exceptions=True)
+    print(f"flood: {len(futures)} queued, {dropped} dropped at the cap of {SEND_CHAT_QUEUE_MAX}")
+
+
+async def fire_and_forget():
+    # как post(): хэндлер ставит запросы в очередь и сразу выходит, правки прогресса схлопываются
+    bot, session, limiter = make_bot()
+    started = time.monotonic()
+    futures = [limiter.submit(session.make_request, bot, SendMessage(chat_id=-1002, text="старт"))]
+    for i in range(10):
+        method = EditMessageText(chat_id=-1002, message_id=1, text=f"прогресс {i}")
+        futures.append(limiter.submit(session.make_request, bot, method))
+    handler_ms = (time.monotonic() - started) * 1000
+    await asyncio.gather(*futures)
+    print(f"fire-and-forget: handler {handler_ms:.2f}ms, 11 calls -> {len(session.calls)} requests")
+
+
+async def retry_after():
+    bot, session, _ = make_bot(fail_first_with_retry_after=1)
+    started = time.monotonic()
+    await bot.send_message(-1001, "после 429")
+    print(f"retry_after: {len(session.calls)} requests, {time.monotonic() - started:.2f}s")
+
+
+async def main():
+    await burst()
+    await edits()
+    await group_edits()
+    await flood()
+    await fire_and_forget()
+    await retry_after()
+    print({k: round(v, 1) for k, v in sorted(METRICS.items()) if k.startswith(("send_", "edit_"))})
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
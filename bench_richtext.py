@@ -0,0 +1,65 @@
+"""
+Микробенчмарк RichText: сборка сообщения на 30 / 300 / 3000 строк в духе страницы топа.
+
+    python bench_richtext.py
+
+Для сравнения рядом гоняется старый билдер, который пересклеивал весь текст на каждом фрагменте.
+"""
+import os
+import timeit
+
+os.environ.setdefault("BOT_TOKEN", "1:bench")
+
+from aiogram import types  # noqa: E402
+
+from pointsbot import RichText  # noqa: E402
+
+
+class LegacyRichText:
+    def __init__(self):
+        self.parts = []
+        self.entities = []
+
+    @property
+    def text(self) -> str:
+        return "".join(self.parts)
+
+    def add(self, s):
+        self.parts.append(str(s))
+        return self
+
+    def bold(self, s):
+        s = str(s)
+        off = len(self.text)
+        self.parts.append(s)
+        self.entities.append(types.MessageEntity(type="bold", offset=off, length=len(s)))
+        return self
+
+    def link(self, label, url):
+        label = str(label)
+        off = len(self.text)
+        self.parts.append(label)
+        self.entities.append(types.MessageEntity(type="text_link", offset=off, length=len(label), url=str(url)))
+        return self
+
+
+def render(cls, lines: int) -> str:
+    b = cls()
+    b.add("🔝 ").bold("ТОП ЛИДЕРОВ").add(" (1/1)\n\n")
+    for i in range(1, lines + 1):
+        b.add(f"{i}. ").link(f"Участник 🦊 {i}", f"https://t.me/user{i}")
+        b.add(" | ").bold(100 - i % 100).add("\n")
+    return b.text
+
+
+def main():
+    print(f"{'lines':>6} | {'RichText, ms':>13} | {'legacy, ms':>11}")
+    for lines in (30, 300, 3000):
+        number = max(1, 3000 // lines)
+        new = min(timeit.repeat(lambda: render(RichText, lines), number=number, repeat=3)) / number
+        old = min(timeit.repeat(lambda: render(LegacyRichText, lines), number=number, repeat=3)) / number
+        print(f"{lines:>6} | {new * 1000:>13.3f} | {old * 1000:>11.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,31 @@
 import asyncio
+import heapq
+import ipaddress
+import json
 import logging
 import os
+import re
 import asyncpg
 import time
 import secrets
+import signal
+from bisect import bisect_left, insort
+from contextlib import asynccontextmanager, suppress
+from contextvars import ContextVar
+from collections import OrderedDict, deque
 from dataclasses import dataclass
-from typing import Optional, Tuple, List, Dict
-from aiogram import Bot, Dispatcher, types, F
+from functools import lru_cache
+from typing import Any, Awaitable, Optional, Tuple, List, Dict, Callable
+from aiogram import BaseMiddleware, Bot, Dispatcher, types, F
 from aiogram.filters import Command
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.methods import EditMessageText
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
 
 TOKEN = os.getenv("BOT_TOKEN")
 OWNER_ID = int(os.getenv("OWNER_ID", "1875573844"))
@@ -21,12 +36,47 @@ MIN_POINTS_TO_TRANSFER = 50
 TRANSFER_RATE = 3
 
 TRANSFER_CONFIRM_TTL = 300
-pending_transfers = {}
 
 
 RESET_CONFIRM_TTL = 300
-pending_resets = {}
+RESET_CHUNK_SIZE = int(os.getenv("RESET_CHUNK_SIZE", "1000"))
+RESET_CHUNK_PAUSE = float(os.getenv("RESET_CHUNK_PAUSE", "0.05"))
+RESET_PROGRESS_INTERVAL = 2.0
+
+# заявки на подтверждение: memory — в процессе, postgres — общая таблица для всех реплик
+PENDING_BACKEND = os.getenv("PENDING_BACKEND", "memory")
+PENDING_MAX = int(os.getenv("PENDING_MAX", "10000"))
+# заявка живёт чуть дольше TTL подтверждения, чтобы успеть показать «истекла»
+PENDING_GRACE = 60
+PENDING_SWEEP_INTERVAL = 30
 ITEMS_PER_PAGE = 30
+# верх топа в памяти: сколько чатов держать (0 — выключено) и сколько первых мест в каждом;
+# 500 чатов × 300 мест ≈ 150k записей, десятки МБ в худшем случае. Дальше окна топ читается из базы
+LEADERBOARD_CHATS = int(os.getenv("LEADERBOARD_CHATS", "500"))
+LEADERBOARD_WINDOW = int(os.getenv("LEADERBOARD_WINDOW", "300"))
+LEADERBOARD_TTL = float(os.getenv("LEADERBOARD_TTL", "900"))
+POINTS_HIST_TTL = float(os.getenv("POINTS_HIST_TTL", "900"))
+RENDER_CACHE_SIZE = int(os.getenv("RENDER_CACHE_SIZE", "512"))
+# исходящие сообщения: общий лимит бота и лимиты на чат (в группах Telegram пускает ~20 новых сообщений в минуту;
+# правки под лимит чата не попадают — только под общий и retry_after)
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "30"))
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", "1"))
+SEND_GROUP_PER_MIN = float(os.getenv("SEND_GROUP_PER_MIN", "20"))
+SEND_CHAT_BURST = int(os.getenv("SEND_CHAT_BURST", "3"))
+SEND_MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", "3"))
+# сколько запросов может ждать в очереди одного чата; лишние отбрасываем (send_dropped)
+SEND_CHAT_QUEUE_MAX = int(os.getenv("SEND_CHAT_QUEUE_MAX", "20"))
+SEND_BUCKETS_MAX = 10000
+SEND_DRAIN_TIMEOUT = 10
+# лог владельцу: очередь событий и сводки раз в AUDIT_FLUSH_INTERVAL
+AUDIT_QUEUE_MAX = int(os.getenv("AUDIT_QUEUE_MAX", "1000"))
+AUDIT_FLUSH_INTERVAL = float(os.getenv("AUDIT_FLUSH_INTERVAL", "5"))
+# неотправленные сводки ждут повтора с растущей паузой до AUDIT_RETRY_MAX; больше AUDIT_OUTBOX_MAX — старые выкидываем
+AUDIT_RETRY_MAX = float(os.getenv("AUDIT_RETRY_MAX", "300"))
+AUDIT_OUTBOX_MAX = int(os.getenv("AUDIT_OUTBOX_MAX", "50"))
+TELEGRAM_TEXT_LIMIT = 4096
+# сколько апдейтов (из разных чатов) обрабатываем одновременно
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "64"))
 logging.basicConfig(level=logging.INFO)
 
 BALANCE_MIN = 0
@@ -38,76 +88,382 @@ bot = Bot(
 )
 dp = Dispatcher()
 
+# polling | webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+# публичный https-адрес вебхука; пусто — set_webhook не вызываем (локальная отладка)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+# обязателен в режиме вебхука, если WEBHOOK_HOST не loopback-адрес
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+# max_connections для Telegram: сколько запросов он держит к нам одновременно
+WEBHOOK_MAX_CONCURRENCY = int(os.getenv("WEBHOOK_MAX_CONCURRENCY", "32"))
+
 DATABASE_URL = os.getenv("DATABASE_URL")
 pool = None
 
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "2"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_MAX_INACTIVE_LIFETIME = float(os.getenv("DB_MAX_INACTIVE_LIFETIME", "300"))
+DB_COMMAND_TIMEOUT = float(os.getenv("DB_COMMAND_TIMEOUT", "30"))
+# кэш неявно подготовленных запросов на соединение (у asyncpg по умолчанию 100)
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "256"))
+
+MEMBER_FLUSH_INTERVAL = float(os.getenv("MEMBER_FLUSH_INTERVAL", "2"))
+MEMBER_FLUSH_MAX_BATCH = int(os.getenv("MEMBER_FLUSH_MAX_BATCH", "5000"))
+# ~300 байт на запись: 100k записей ≈ 30 МБ
+MEMBER_CACHE_SIZE = int(os.getenv("MEMBER_CACHE_SIZE", "100000"))
+MEMBER_CACHE_TTL = float(os.getenv("MEMBER_CACHE_TTL", "3600"))
+USERNAME_CACHE_SIZE = int(os.getenv("USERNAME_CACHE_SIZE", "50000"))
+USERNAME_CACHE_TTL = float(os.getenv("USERNAME_CACHE_TTL", "600"))
+# get_chat_member: «в чате» помним дольше, «не в чате» — недолго (могут зайти)
+MEMBERSHIP_CACHE_SIZE = int(os.getenv("MEMBERSHIP_CACHE_SIZE", "50000"))
+MEMBERSHIP_TTL = float(os.getenv("MEMBERSHIP_TTL", "600"))
+MEMBERSHIP_NEGATIVE_TTL = float(os.getenv("MEMBERSHIP_NEGATIVE_TTL", "60"))
+CHAT_SETTINGS_TTL = float(os.getenv("CHAT_SETTINGS_TTL", "600"))
+ADMIN_CACHE_CHATS = int(os.getenv("ADMIN_CACHE_CHATS", "5000"))
+ADMIN_CACHE_TTL = float(os.getenv("ADMIN_CACHE_TTL", "300"))
+
+# LISTEN/NOTIFY: сбрасываем кэши на остальных репликах бота
+PG_NOTIFY = os.getenv("PG_NOTIFY", "1") == "1"
+NOTIFY_CHANNEL = "pointsbot_invalidate"
+INSTANCE_ID = secrets.token_hex(4)
+
+METRICS: Dict[str, float] = {}
+
+
+def metric_inc(name: str, value: float = 1) -> None:
+    METRICS[name] = METRICS.get(name, 0) + value
+
+
+def metric_set(name: str, value: float) -> None:
+    METRICS[name] = value
+
+
+def metric_max(name: str, value: float) -> None:
+    if value > METRICS.get(name, 0):
+        METRICS[name] = value
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated", "blocked_until")
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    async def take(self):
+        while True:
+            now = time.monotonic()
+            if now < self.blocked_until:
+                await asyncio.sleep(self.blocked_until - now)
+                continue
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    async def wait_unblocked(self):
+        # дождаться конца retry_after, не тратя токен
+        while (left := self.blocked_until - time.monotonic()) > 0:
+            await asyncio.sleep(left)
+
+    def block(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class OutboundQueueFull(Exception):
+    """Очередь чата переполнена — запрос не поставлен."""
+
+
+class OutboundJob:
+    __slots__ = ("method", "future", "make_request", "bot", "started")
+
+    def __init__(self, method, make_request, bot):
+        self.method = method
+        self.future = asyncio.get_running_loop().create_future()
+        self.make_request = make_request
+        self.bot = bot
+        self.started = time.monotonic()
+
+
+class ChatOutbox:
+    __slots__ = ("bucket", "jobs", "edits", "worker")
+
+    def __init__(self, bucket: TokenBucket):
+        self.bucket = bucket
+        self.jobs: "deque[OutboundJob]" = deque()
+        # message_id -> ещё не отправленная правка этого сообщения
+        self.edits: Dict[int, OutboundJob] = {}
+        self.worker: asyncio.Task | None = None
+
+
+class OutboundLimiter(BaseRequestMiddleware):
+    """
+    Middleware сессии бота: все отправки (send*/edit*/copy*/forward*) встают в очередь своего чата,
+    её разбирает отдельный воркер — через token bucket чата и общий. Правки (edit*) лимит чата
+    не тратят: на них в Telegram лимит групп не действует, а на них держится весь UI с кнопками.
+    Порядок внутри чата сохраняется, хэндлер в очереди не стоит: post() кладёт запрос и сразу возвращается.
+    В очереди чата не больше SEND_CHAT_QUEUE_MAX запросов, новые сверх этого отклоняются с OutboundQueueFull.
+    На 429 воркер ждёт retry_after (весь чат стоит) и повторяет до SEND_MAX_RETRIES раз.
+    Правка сообщения, уже ждущего отправки правки, подменяет её текст: уходит только последняя,
+    все ожидающие получают её результат.
+    """
+
+    LIMITED_PREFIXES = ("Send", "Edit", "Copy", "Forward")
+
+    def __init__(self):
+        self.global_bucket = TokenBucket(SEND_GLOBAL_RATE, SEND_GLOBAL_RATE)
+        self.outboxes: "OrderedDict[int | str, ChatOutbox]" = OrderedDict()
+        self.queued = 0
+
+    def is_limited(self, method) -> bool:
+        return getattr(method, "chat_id", None) is not None and type(method).__name__.startswith(self.LIMITED_PREFIXES)
+
+    @staticmethod
+    def charges_chat(method) -> bool:
+        return not type(method).__name__.startswith("Edit")
+
+    async def _wait_turn(self, job: OutboundJob, bucket: TokenBucket):
+        if self.charges_chat(job.method):
+            await bucket.take()
+        else:
+            await bucket.wait_unblocked()
+        await self.global_bucket.take()
+
+    def _outbox(self, chat_id) -> ChatOutbox:
+        outbox = self.outboxes.get(chat_id)
+        if outbox is not None:
+            self.outboxes.move_to_end(chat_id)
+            return outbox
+
+        is_group = isinstance(chat_id, str) or chat_id < 0
+        rate = SEND_GROUP_PER_MIN / 60 if is_group else SEND_CHAT_RATE
+        outbox = self.outboxes[chat_id] = ChatOutbox(TokenBucket(rate, SEND_CHAT_BURST))
+        if len(self.outboxes) > SEND_BUCKETS_MAX:
+            # выкидываем только простаивающие чаты, самые давние первыми
+            for key in [k for k, o in self.outboxes.items() if o.worker is None and not o.jobs]:
+                if len(self.outboxes) <= SEND_BUCKETS_MAX:
+                    break
+                del self.outboxes[key]
+        return outbox
+
+    def _set_queued(self, delta: int):
+        self.queued += delta
+        metric_set("send_queued", self.queued)
+        metric_max("send_queued_max", self.queued)
+
+    def submit(self, make_request, bot, method) -> asyncio.Future:
+        """
+        Ставит запрос в очередь чата (синхронно — порядок вызовов и есть порядок отправки).
+        """
+        chat_id = method.chat_id
+        outbox = self._outbox(chat_id)
+
+        message_id = method.message_id if isinstance(method, EditMessageText) else None
+        if message_id is not None:
+            job = outbox.edits.get(message_id)
+            if job is not None:
+                job.method = method
+                metric_inc("edit_coalesced")
+                return job.future
+
+        if len(outbox.jobs) >= SEND_CHAT_QUEUE_MAX:
+            metric_inc("send_dropped")
+            fut = asyncio.get_running_loop().create_future()
+            fut.set_exception(OutboundQueueFull(f"outbound queue of chat {chat_id} is full"))
+            return fut
+
+        job = OutboundJob(method, make_request, bot)
+        outbox.jobs.append(job)
+        if message_id is not None:
+            outbox.edits[message_id] = job
+        self._set_queued(1)
+        if outbox.worker is None:
+            outbox.worker = asyncio.create_task(self._drain(outbox))
+        return job.future
+
+    async def _drain(self, outbox: ChatOutbox):
+        try:
+            while outbox.jobs:
+                job = outbox.jobs[0]
+                await self._wait_turn(job, outbox.bucket)
+                # с этого момента новые правки того же сообщения — уже отдельная отправка
+                outbox.jobs.popleft()
+                message_id = getattr(job.method, "message_id", None)
+                if outbox.edits.get(message_id) is job:
+                    del outbox.edits[message_id]
+                self._set_queued(-1)
+
+                if job.future.done():
+                    # ждущий отменил запрос, пока тот стоял в очереди
+                    continue
+                try:
+                    result = await self._send(job, outbox.bucket)
+                except Exception as e:
+                    if not job.future.done():
+                        job.future.set_exception(e)
+                else:
+                    if not job.future.done():
+                        job.future.set_result(result)
+        finally:
+            outbox.worker = None
+            for job in outbox.jobs:
+                if not job.future.done():
+                    job.future.cancel()
+            self._set_queued(-len(outbox.jobs))
+            outbox.jobs.clear()
+            outbox.edits.clear()
+
+    async def _send(self, job: OutboundJob, bucket: TokenBucket):
+        for attempt in range(SEND_MAX_RETRIES + 1):
+            try:
+                result = await job.make_request(job.bot, job.method)
+            except TelegramRetryAfter as e:
+                metric_inc("send_retry_after")
+                if attempt == SEND_MAX_RETRIES:
+                    raise
+                # лимит на весь бот Telegram отдаёт так же, как на чат; не знаем какой — тормозим чат
+                bucket.block(e.retry_after)
+                await self._wait_turn(job, bucket)
+                continue
+            latency = (time.monotonic() - job.started) * 1000
+            metric_inc("send_total")
+            metric_inc("send_latency_ms_total", latency)
+            metric_max("send_latency_ms_max", latency)
+            return result
+
+    async def __call__(self, make_request, bot, method):
+        if not self.is_limited(method):
+            return await make_request(bot, method)
+        return await asyncio.shield(self.submit(make_request, bot, method))
+
+    async def drain(self, timeout: float):
+        """Дождаться отправки всего, что уже в очередях (при остановке, до закрытия сессии)."""
+        workers = [o.worker for o in self.outboxes.values() if o.worker is not None]
+        if workers:
+            await asyncio.wait(workers, timeout=timeout)
+
+
+outbound = OutboundLimiter()
+bot.session.middleware(outbound)
+
+
+def _log_post_result(fut: asyncio.Future):
+    if fut.cancelled():
+        return
+    e = fut.exception()
+    if isinstance(e, OutboundQueueFull):
+        # уже посчитано в send_dropped, в лог флуд не пишем
+        return
+    if e is not None:
+        metric_inc("send_errors")
+        logging.warning(f"Outbound request failed: {e}")
+
+
+def post(method) -> None:
+    """
+    Отправить без ожидания: запрос встаёт в очередь чата, ошибки только логируются.
+    post(message.reply("...")) — хэндлер не ждёт ни лимитов, ни ответа Telegram.
+    """
+    if outbound.is_limited(method):
+        fut = outbound.submit(bot.session.make_request, bot, method)
+    else:
+        fut = asyncio.ensure_future(bot(method))
+    fut.add_done_callback(_log_post_result)
+
 
 PLACEHOLDER = "⬜"
 
-@dataclass
 class RichText:
-    parts: List[str]
-    entities: List[types.MessageEntity]
+    """
+    Билдер текста с entities. Длину держим нарастающим итогом (в символах Python и в UTF-16),
+    итоговая строка склеивается один раз — при первом обращении к text.
+    spans — entities сразу в UTF-16 units (как требует Telegram): (type, offset, length, extra),
+    extra — url для text_link или custom_emoji_id для custom_emoji.
+    """
+    __slots__ = ("parts", "spans", "length", "u16_length", "_text")
 
     def __init__(self):
-        self.parts = []
-        self.entities = []
+        self.parts: List[str] = []
+        self.spans: List[Tuple[str, int, int, str | None]] = []
+        self.length = 0
+        self.u16_length = 0
+        self._text: str | None = None
 
     @property
     def text(self) -> str:
-        return "".join(self.parts)
+        if self._text is None:
+            self._text = "".join(self.parts)
+        return self._text
+
+    def _append(self, s: str) -> Tuple[int, int]:
+        off = self.u16_length
+        n = u16len(s)
+        self.parts.append(s)
+        self.length += len(s)
+        self.u16_length += n
+        self._text = None
+        return off, n
+
+    def _styled(self, kind: str, s, extra: str | None = None) -> "RichText":
+        off, n = self._append(str(s))
+        self.spans.append((kind, off, n, extra))
+        return self
 
     def add(self, s: str) -> "RichText":
-        self.parts.append(str(s))
+        self._append(str(s))
         return self
 
     def bold(self, s: str) -> "RichText":
-        s = str(s)
-        off = len(self.text)
-        self.parts.append(s)
-        self.entities.append(types.MessageEntity(type="bold", offset=off, length=len(s)))
-        return self
+        return self._styled("bold", s)
 
     def italic(self, s: str) -> "RichText":
-        s = str(s)
-        off = len(self.text)
-        self.parts.append(s)
-        self.entities.append(types.MessageEntity(type="italic", offset=off, length=len(s)))
-        return self
+        return self._styled("italic", s)
 
     def code(self, s: str) -> "RichText":
-        s = str(s)
-        off = len(self.text)
-        self.parts.append(s)
-        self.entities.append(types.MessageEntity(type="code", offset=off, length=len(s)))
-        return self
+        return self._styled("code", s)
 
     def link(self, label: str, url: str) -> "RichText":
-        label = str(label)
-        off = len(self.text)
-        self.parts.append(label)
-        self.entities.append(types.MessageEntity(type="text_link", offset=off, length=len(label), url=str(url)))
-        return self
+        return self._styled("text_link", label, str(url))
 
 
 def u16len(s: str) -> int:
     return len(s.encode("utf-16-le")) // 2
 
-def to_utf16_entities(text: str, entities: list[types.MessageEntity]) -> list[types.MessageEntity]:
+
+_ASTRAL_RE = re.compile("[\U00010000-\U0010FFFF]")
+
+
+def u16_offsets(text: str) -> Callable[[int], int]:
     """
-    Конвертирует offsets/length из python-индексов (len)
-    в UTF-16 units (как требует Telegram).
+    Перевод python-индекса в UTF-16 offset: индекс + число суррогатных пар левее него.
+    Позиции астральных символов собираются один раз на текст.
     """
-    out = []
-    for e in entities:
-        d = e.model_dump()
-        py_off = int(d.get("offset", 0))
-        py_len = int(d.get("length", 0))
+    astral = [m.start() for m in _ASTRAL_RE.finditer(text)]
+    if not astral:
+        return lambda i: i
+    return lambda i: i + bisect_left(astral, i)
 
-        d["offset"] = u16len(text[:py_off])
-        d["length"] = u16len(text[py_off:py_off + py_len])
 
-        out.append(types.MessageEntity(**d))
+def spans_to_entities(spans: List[Tuple[str, int, int, str | None]]) -> List[types.MessageEntity]:
+    # offsets уже в UTF-16 и проверены билдером — без повторной валидации pydantic
+    out = []
+    for kind, off, length, extra in spans:
+        if kind == "text_link":
+            out.append(types.MessageEntity.model_construct(type=kind, offset=off, length=length, url=extra))
+        elif kind == "custom_emoji":
+            out.append(types.MessageEntity.model_construct(
+                type=kind, offset=off, length=length, custom_emoji_id=extra
+            ))
+        else:
+            out.append(types.MessageEntity.model_construct(type=kind, offset=off, length=length))
     return out
 
 
@@ -122,101 +478,129 @@ def emoji_variants(s: str) -> list[str]:
     return out
 
 
-async def send_rich(message_or_cbmsg, rich: RichText, reply_markup=None, edit: bool = False):
+async def render_rich(rich: RichText, emoji_map=None) -> Tuple[str, List[types.MessageEntity]]:
     """
-    Универсальная отправка/редактирование: всегда entities.
-    Перед отправкой автоматически заменяет настроенные эмодзи на custom_emoji.
+    Финальный текст и entities: настроенные эмодзи заменены на custom_emoji.
+    emoji_map — готовый снимок карты; без него берётся текущая.
     """
-    final_text, final_entities = await apply_custom_emojis(
+    final_text, final_spans = await apply_custom_emojis(
         chat_id=0,
         text=rich.text,
-        entities=rich.entities
+        spans=rich.spans,
+        emoji_map=emoji_map
     )
+    return final_text, spans_to_entities(final_spans)
 
-    final_entities = to_utf16_entities(final_text, final_entities)
 
+async def send_rendered(message_or_cbmsg, text: str, entities, reply_markup=None, edit: bool = False):
     if edit:
-        await message_or_cbmsg.edit_text(
-    final_text,
-    entities=final_entities,
+        post(message_or_cbmsg.edit_text(
+    text,
+    entities=entities,
     reply_markup=reply_markup,
     disable_web_page_preview=True,
     parse_mode=None
-        )
+        ))
     else:
-        await message_or_cbmsg.answer(
-    final_text,
-    entities=final_entities,
+        post(message_or_cbmsg.answer(
+    text,
+    entities=entities,
     reply_markup=reply_markup,
     disable_web_page_preview=True,
     parse_mode=None
-        )
-
-def _adjust_entities_for_replacement(
-    entities: list[types.MessageEntity],
-    s: int,
-    e: int,
-    delta: int
-) -> list[types.MessageEntity]:
-    new_ents = []
-
-    for ent in entities:
-        ent_start = int(ent.offset)
-        ent_len = int(ent.length)
-        ent_end = ent_start + ent_len
-
-        if ent_end <= s:
-            new_ents.append(ent)
-            continue
+        ))
 
-        if ent_start >= e:
-            ent.offset = ent_start + delta
-            new_ents.append(ent)
-            continue
 
-        if ent_start >= s and ent_end <= e:
-            continue
+async def send_rich(message_or_cbmsg, rich: RichText, reply_markup=None, edit: bool = False):
+    """
+    Универсальная отправка/редактирование: всегда entities.
+    Перед отправкой автоматически заменяет настроенные эмодзи на custom_emoji.
+    """
+    final_text, final_entities = await render_rich(rich)
+    await send_rendered(message_or_cbmsg, final_text, final_entities, reply_markup=reply_markup, edit=edit)
 
-        if ent_start < s and ent_end <= e:
-            ent.length = max(0, s - ent_start)
-            if ent.length > 0:
-                new_ents.append(ent)
-            continue
 
-        if ent_start >= s and ent_start < e and ent_end > e:
-            tail = ent_end - e
-            ent.offset = s
-            ent.length = 1 + tail
-            if ent.length > 0:
-                new_ents.append(ent)
-            continue
+_render_cache: "OrderedDict[tuple, Tuple[str, List[types.MessageEntity]]]" = OrderedDict()
 
-        if ent_start < s and ent_end > e:
-            ent.length = ent_len + delta
-            if ent.length > 0:
-                new_ents.append(ent)
-            continue
 
-        new_ents.append(ent)
+async def render_cached(key: tuple, build: Callable[[], RichText]) -> Tuple[str, List[types.MessageEntity]]:
+    """
+    Готовый текст+entities статичных экранов (меню, помощь, «О рейтинге»).
+    key должен включать всё, от чего зависит экран; версия карты эмодзи добавляется сама.
+    """
+    emoji_map = await get_emoji_map(0)
+    # версия и карта читаются вместе, без await между ними; рендерим ровно по этому снимку
+    version = _EMOJI_MAP_VERSION
+    current = emoji_map is _EMOJI_MAP
+    full_key = key + (version,)
+    hit = _render_cache.get(full_key) if current else None
+    if hit is not None:
+        _render_cache.move_to_end(full_key)
+        metric_inc("render_cache_hit")
+        return hit
+
+    metric_inc("render_cache_miss")
+    rendered = await render_rich(build(), emoji_map=emoji_map)
+    if not current or version != _EMOJI_MAP_VERSION:
+        # карту подменили, пока рендерили: результат верен для запроса, но не для кэша
+        return rendered
+    _render_cache[full_key] = rendered
+    while len(_render_cache) > RENDER_CACHE_SIZE:
+        _render_cache.popitem(last=False)
+    return rendered
+
+
+_EMOJI_MAP: Dict[str, Tuple[str, bool]] | None = None
+_EMOJI_MAP_VERSION = 0
+# последняя загруженная карта: сбрасывать _EMOJI_MAP можно, а версию двигаем только при новом содержимом
+_emoji_map_last: Dict[str, Tuple[str, bool]] | None = None
+_emoji_generation = 0
+_emoji_map_load: asyncio.Future | None = None
+
+
+def _set_emoji_map(m: Dict[str, Tuple[str, bool]] | None):
+    """
+    Версия карты меняется только вместе с содержимым: перечитанная без изменений карта
+    подменяется прежним объектом, и кэш рендеров с матчером остаются в силе.
+    """
+    global _EMOJI_MAP, _EMOJI_MAP_VERSION, _emoji_map_last
+    if m is not None and m == _emoji_map_last:
+        _EMOJI_MAP = _emoji_map_last
+        metric_inc("emoji_map_unchanged")
+        return
+    _EMOJI_MAP = m
+    if m is not None:
+        _emoji_map_last = m
+        _EMOJI_MAP_VERSION += 1
 
-    return new_ents
 
+def invalidate_emoji_map():
+    global _emoji_generation
+    _emoji_generation += 1
+    _set_emoji_map(None)
 
-_EMOJI_CACHE: Tuple[float, Dict[str, Tuple[str, bool]]] | None = None
-_EMOJI_CACHE_TTL = 10.0
 
-async def get_emoji_map(chat_id: int = 0) -> Dict[str, Tuple[str, bool]]:
+def update_emoji_map(emoji_text: str, value: Tuple[str, bool] | None):
     """
-    Глобальные эмодзи для всех чатов: читаем только chat_id = 0.
-    returns dict: emoji_text -> (custom_emoji_id, enabled)
+    Правка загруженной карты без похода в базу. Карту не мутируем, а подменяем копией:
+    тем, кто уже держит старую, ничего не сломаем, а матчер пересоберётся по новой версии.
     """
-    global _EMOJI_CACHE
-    now = time.time()
+    global _emoji_generation
+    _emoji_generation += 1
+    if _EMOJI_MAP is None or _EMOJI_MAP.get(emoji_text) == value:
+        return
+    m = dict(_EMOJI_MAP)
+    if value is None:
+        m.pop(emoji_text, None)
+    else:
+        m[emoji_text] = value
+    _set_emoji_map(m)
 
-    if _EMOJI_CACHE and (now - _EMOJI_CACHE[0]) < _EMOJI_CACHE_TTL:
-        return _EMOJI_CACHE[1]
 
-    async with pool.acquire() as conn:
+async def _load_emoji_map() -> Dict[str, Tuple[str, bool]]:
+    metric_inc("emoji_map_loads")
+    generation = _emoji_generation
+    async with db_conn() as conn:
         rows = await conn.fetch(
             "SELECT emoji_text, custom_emoji_id, enabled FROM chat_emojis WHERE chat_id = 0"
         )
@@ -229,78 +613,139 @@ async def get_emoji_map(chat_id: int = 0) -> Dict[str, Tuple[str, bool]]:
         if cid:
             m[et] = (str(cid), en)
 
-    _EMOJI_CACHE = (now, m)
+    if generation == _emoji_generation:
+        _set_emoji_map(m)
+        return _EMOJI_MAP
     return m
 
-async def apply_custom_emojis(
-    chat_id: int,
-    text: str,
-    entities: List[types.MessageEntity]
-) -> Tuple[str, List[types.MessageEntity]]:
-    emoji_map = await get_emoji_map(chat_id)
-    if not emoji_map:
-        return text, entities
 
-    matches = []
+async def get_emoji_map(chat_id: int = 0) -> Dict[str, Tuple[str, bool]]:
+    """
+    Глобальные эмодзи для всех чатов: читаем только chat_id = 0.
+    returns dict: emoji_text -> (custom_emoji_id, enabled)
+    Карта грузится один раз и дальше правится на месте командами /эмодзи
+    и по NOTIFY от других реплик; одновременно идёт не больше одной загрузки.
+    """
+    global _emoji_map_load
+    if _EMOJI_MAP is not None:
+        return _EMOJI_MAP
+
+    if _emoji_map_load is None or _emoji_map_load.done():
+        _emoji_map_load = asyncio.ensure_future(_load_emoji_map())
+    return await asyncio.shield(_emoji_map_load)
+
+
+_EMOJI_MATCHER: Tuple[int, "re.Pattern | None", Dict[str, str]] | None = None
+
+
+def compile_emoji_matcher(emoji_map: Dict[str, Tuple[str, bool]]) -> Tuple["re.Pattern | None", Dict[str, str]]:
+    """
+    Один regex на все включённые триггеры и их варианты, длинные раньше коротких:
+    finditer тогда сам даёт самые длинные непересекающиеся совпадения слева направо.
+    """
+    ids: Dict[str, str] = {}
     for emoji_text, (custom_id, enabled) in emoji_map.items():
-        if not enabled or not custom_id:
-            continue
-        if not emoji_text:
+        if not enabled or not custom_id or not emoji_text:
             continue
-
         for key in emoji_variants(emoji_text):
-            start = 0
-            while True:
-                idx = text.find(key, start)
-                if idx == -1:
-                    break
-                matches.append((idx, idx + len(key), key, str(custom_id)))
-                start = idx + len(key)
+            ids.setdefault(key, str(custom_id))
 
-    if not matches:
-        return text, entities
+    if not ids:
+        return None, ids
+    keys = sorted(ids, key=len, reverse=True)
+    return re.compile("|".join(map(re.escape, keys))), ids
 
-    matches.sort(key=lambda x: (x[0], -(x[1] - x[0])))
 
-    selected = []
-    for s, e, key, cid in matches:
-        ok = True
-        for ss, ee, _, _ in selected:
-            if not (e <= ss or ee <= s):
-                ok = False
-                break
-        if ok:
-            selected.append((s, e, key, cid))
+def get_emoji_matcher(emoji_map: Dict[str, Tuple[str, bool]]) -> Tuple["re.Pattern | None", Dict[str, str]]:
+    global _EMOJI_MATCHER
+    if emoji_map is not _EMOJI_MAP:
+        # карту уже успели подменить — собираем разово, не трогая закэшированный матчер
+        return compile_emoji_matcher(emoji_map)
+    if _EMOJI_MATCHER is None or _EMOJI_MATCHER[0] != _EMOJI_MAP_VERSION:
+        pattern, ids = compile_emoji_matcher(emoji_map)
+        _EMOJI_MATCHER = (_EMOJI_MAP_VERSION, pattern, ids)
+        metric_inc("emoji_matcher_builds")
+    return _EMOJI_MATCHER[1], _EMOJI_MATCHER[2]
 
-    selected.sort(key=lambda x: x[0], reverse=True)
 
-    ents = [types.MessageEntity(**en.model_dump()) for en in entities]
+async def apply_custom_emojis(
+    chat_id: int,
+    text: str,
+    spans: list,
+    emoji_map: Dict[str, Tuple[str, bool]] | None = None
+) -> Tuple[str, list]:
+    """
+    Заменяет настроенные эмодзи на PLACEHOLDER + custom_emoji за один проход по тексту.
+    spans и результат — в UTF-16 units.
+    """
+    if emoji_map is None:
+        emoji_map = await get_emoji_map(chat_id)
+    if not emoji_map:
+        return text, spans
 
-    for s, e, key, custom_id in selected:
-        old_len = e - s
-        text = text[:s] + PLACEHOLDER + text[e:]
+    pattern, ids = get_emoji_matcher(emoji_map)
+    if pattern is None:
+        return text, spans
 
-        delta = 1 - old_len
-        ents = _adjust_entities_for_replacement(ents, s, e, delta)
+    to_u16 = u16_offsets(text)
+    out = []
+    pos = 0
+    # для каждой замены: начало и конец в исходном тексте (UTF-16) и суммарный сдвиг до неё
+    starts, ends = [], []
+    shift_before = [0]
+    ents = []
+
+    for m in pattern.finditer(text):
+        s, e = m.span()
+        s16, e16 = to_u16(s), to_u16(e)
+        out.append(text[pos:s])
+        out.append(PLACEHOLDER)
+        pos = e
+
+        starts.append(s16)
+        ends.append(e16)
+        ents.append(("custom_emoji", s16 + shift_before[-1], 1, ids[m.group()]))
+        shift_before.append(shift_before[-1] + 1 - (e16 - s16))
+
+    if not starts:
+        return text, spans
+    out.append(text[pos:])
+
+    for kind, ent_start, ent_len, extra in spans:
+        # правила те же, что при поочерёдной замене справа налево, но проходим
+        # только замены, задевающие entity; всё левее — просто суммарный сдвиг
+        i = bisect_left(starts, ent_start + ent_len) - 1
+        alive = True
+        while i >= 0 and ends[i] > ent_start:
+            s16, e16 = starts[i], ends[i]
+            ent_end = ent_start + ent_len
+            if ent_end <= s16:
+                pass
+            elif ent_start >= s16 and ent_end <= e16:
+                alive = False
+                break
+            elif ent_start < s16 and ent_end <= e16:
+                ent_len = s16 - ent_start
+            elif ent_start >= s16:
+                ent_len = 1 + ent_end - e16
+                ent_start = s16
+            else:
+                ent_len += shift_before[i + 1] - shift_before[i]
+            i -= 1
 
-        ents.append(types.MessageEntity(
-            type="custom_emoji",
-            offset=s,
-            length=1,
-            custom_emoji_id=str(custom_id)
-        ))
+        if alive:
+            ents.append((kind, ent_start + shift_before[i + 1], ent_len, extra))
 
-    ents.sort(key=lambda x: x.offset)
-    return text, ents
+    ents.sort(key=lambda x: x[1])
+    return "".join(out), ents
 
 
 async def set_chat_emoji(chat_id: int, emoji_text: str, custom_emoji_id: str, enabled: bool = True):
-    global _EMOJI_CACHE
     emoji_text = (emoji_text or "").strip()
     custom_emoji_id = (custom_emoji_id or "").strip()
     if not emoji_text:
         return
-    async with pool.acquire() as conn:
+    async with db_conn() as conn:
         await conn.execute("""
             INSERT INTO chat_emojis (chat_id, emoji_text, custom_emoji_id, enabled)
             VALUES ($1, $2, $3, $4)
@@ -308,38 +753,56 @@ async def set_chat_emoji(chat_id: int, emoji_text: str, custom_emoji_id: str, en
             DO UPDATE SET custom_emoji_id = EXCLUDED.custom_emoji_id,
                           enabled = EXCLUDED.enabled
         """, chat_id, emoji_text, custom_emoji_id, bool(enabled))
+        if chat_id == 0:
+            await notify_invalidate(conn, "emoji")
 
-    global _EMOJI_CACHE
-    _EMOJI_CACHE = None
+    if chat_id == 0:
+        update_emoji_map(emoji_text, (custom_emoji_id, bool(enabled)) if custom_emoji_id else None)
 
 
 async def toggle_chat_emoji(chat_id: int, emoji_text: str, enabled: bool):
-    global _EMOJI_CACHE
     emoji_text = (emoji_text or "").strip()
     if not emoji_text:
         return
-    async with pool.acquire() as conn:
-        await conn.execute("""
+    async with db_conn() as conn:
+        row = await conn.fetchrow("""
             INSERT INTO chat_emojis (chat_id, emoji_text, custom_emoji_id, enabled)
             VALUES ($1, $2, NULL, $3)
             ON CONFLICT (chat_id, emoji_text)
             DO UPDATE SET enabled = EXCLUDED.enabled
+            RETURNING custom_emoji_id, enabled
         """, chat_id, emoji_text, bool(enabled))
+        if chat_id == 0:
+            await notify_invalidate(conn, "emoji")
 
-    global _EMOJI_CACHE
-    _EMOJI_CACHE = None
+    if chat_id == 0:
+        cid = row["custom_emoji_id"]
+        update_emoji_map(emoji_text, (str(cid), bool(row["enabled"])) if cid else None)
 
 
 async def delete_chat_emoji(chat_id: int, emoji_text: str):
-    global _EMOJI_CACHE
     emoji_text = (emoji_text or "").strip()
     if not emoji_text:
         return
-    async with pool.acquire() as conn:
+    async with db_conn() as conn:
         await conn.execute("DELETE FROM chat_emojis WHERE chat_id = $1 AND emoji_text = $2", chat_id, emoji_text)
+        if chat_id == 0:
+            await notify_invalidate(conn, "emoji")
+
+    if chat_id == 0:
+        update_emoji_map(emoji_text, None)
+
+
+async def clear_chat_emojis(chat_id: int):
+    global _emoji_generation
+    async with db_conn() as conn:
+        await conn.execute("DELETE FROM chat_emojis WHERE chat_id = $1", chat_id)
+        if chat_id == 0:
+            await notify_invalidate(conn, "emoji")
 
-    global _EMOJI_CACHE
-    _EMOJI_CACHE = None
+    if chat_id == 0:
+        _emoji_generation += 1
+        _set_emoji_map({})
 
 
 POINT_ROLES = [
@@ -418,10 +881,341 @@ RATING_INFO_TEXT = (
 )
 
 
+_INVALIDATORS: Dict[str, Callable[[str], None]] = {
+    "settings": lambda arg: invalidate_chat_settings(None if arg == "*" else int(arg)),
+    "admins": lambda arg: invalidate_admins(None if arg == "*" else int(arg)),
+    "emoji": lambda arg: invalidate_emoji_map(),
+}
+_listen_conn: asyncpg.Connection | None = None
+_listen_stopping = False
+_listen_retry: asyncio.Task | None = None
+
+
+async def notify_invalidate(conn, kind: str, arg="") -> None:
+    if not PG_NOTIFY:
+        return
+    await conn.execute("SELECT pg_notify($1, $2)", NOTIFY_CHANNEL, f"{INSTANCE_ID}:{kind}:{arg}")
+
+
+def _on_invalidate(conn, pid, channel, payload):
+    origin, _, rest = payload.partition(":")
+    if origin == INSTANCE_ID:
+        return
+    kind, _, arg = rest.partition(":")
+    handler = _INVALIDATORS.get(kind)
+    if handler is None:
+        return
+    metric_inc("notify_received")
+    try:
+        handler(arg)
+    except Exception as e:
+        logging.warning(f"Bad invalidation payload {payload!r}: {e}")
+
+
+def _on_listen_lost(conn):
+    global _listen_conn
+    _listen_conn = None
+    if _listen_stopping:
+        return
+    logging.warning("Invalidation listener lost, dropping caches and reconnecting")
+    metric_inc("notify_reconnects")
+    # пропущенные уведомления не восстановить — чистим всё, что ими инвалидируется
+    for handler in _INVALIDATORS.values():
+        handler("*")
+    _schedule_listen_retry(5)
+
+
+def _schedule_listen_retry(delay: float):
+    global _listen_retry
+    _listen_retry = asyncio.get_running_loop().create_task(start_invalidation_listener(delay=delay))
+
+
+async def start_invalidation_listener(delay: float = 0):
+    global _listen_conn
+    if not PG_NOTIFY:
+        return
+    if delay:
+        await asyncio.sleep(delay)
+    try:
+        conn = await asyncpg.connect(DATABASE_URL)
+        await conn.add_listener(NOTIFY_CHANNEL, _on_invalidate)
+        conn.add_termination_listener(_on_listen_lost)
+        _listen_conn = conn
+    except Exception as e:
+        logging.warning(f"Failed to start invalidation listener: {e}")
+        if not _listen_stopping:
+            _schedule_listen_retry(30)
+
+
+async def stop_invalidation_listener():
+    global _listen_stopping
+    _listen_stopping = True
+    if _listen_retry is not None:
+        _listen_retry.cancel()
+    if _listen_conn is not None:
+        with suppress(Exception):
+            await _listen_conn.close()
+
+
+class PendingStore:
+    """
+    Заявки на подтверждение с TTL и жёстким лимитом размера.
+    В памяти — dict + heap по времени истечения; протухшие выметает sweep() из фоновой задачи,
+    при переполнении первыми вытесняются те, что истекают раньше.
+    С PENDING_BACKEND=postgres заявки лежат в pending_confirmations: переживают рестарт,
+    а pop() через DELETE ... RETURNING отдаёт заявку ровно одной реплике.
+    """
+
+    def __init__(self, kind: str, ttl: float, max_size: int = PENDING_MAX):
+        self.kind = kind
+        self.ttl = ttl
+        self.max_size = max_size
+        self._items: Dict[str, Tuple[float, dict]] = {}
+        self._heap: List[Tuple[float, str]] = []
+
+    @property
+    def persistent(self) -> bool:
+        return PENDING_BACKEND == "postgres"
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    async def put(self, token: str, data: dict):
+        if self.persistent:
+            async with db_conn() as conn:
+                await conn.execute(
+                    "INSERT INTO pending_confirmations (token, kind, payload, expires_at) "
+                    "VALUES ($1, $2, $3::jsonb, now() + make_interval(secs => $4))",
+                    token, self.kind, json.dumps(data), float(self.ttl)
+                )
+            return
+
+        expires = time.monotonic() + self.ttl
+        self._items[token] = (expires, data)
+        heapq.heappush(self._heap, (expires, token))
+        while len(self._items) > self.max_size:
+            self._evict_first()
+            metric_inc(f"pending_{self.kind}_evicted")
+
+    async def get(self, token: str) -> dict | None:
+        if self.persistent:
+            async with db_conn() as conn:
+                payload = await conn.fetchval(
+                    "SELECT payload FROM pending_confirmations "
+                    "WHERE token = $1 AND kind = $2 AND expires_at > now()",
+                    token, self.kind
+                )
+            return json.loads(payload) if payload is not None else None
+
+        item = self._items.get(token)
+        if item is None or item[0] <= time.monotonic():
+            return None
+        return item[1]
+
+    async def pop(self, token: str) -> dict | None:
+        if self.persistent:
+            async with db_conn() as conn:
+                payload = await conn.fetchval(
+                    "DELETE FROM pending_confirmations WHERE token = $1 AND kind = $2 RETURNING payload",
+                    token, self.kind
+                )
+            return json.loads(payload) if payload is not None else None
+
+        item = self._items.pop(token, None)
+        return item[1] if item is not None else None
+
+    def _evict_first(self):
+        while self._heap:
+            expires, token = heapq.heappop(self._heap)
+            item = self._items.get(token)
+            # в heap могут остаться записи уже забранных заявок — их просто пропускаем
+            if item is not None and item[0] == expires:
+                del self._items[token]
+                return
+
+    async def sweep(self) -> int:
+        if self.persistent:
+            async with db_conn() as conn:
+                status = await conn.execute(
+                    "DELETE FROM pending_confirmations WHERE kind = $1 AND expires_at <= now()",
+                    self.kind
+                )
+            removed = int(status.split()[-1])
+        else:
+            removed = 0
+            now = time.monotonic()
+            while self._heap and self._heap[0][0] <= now:
+                expires, token = heapq.heappop(self._heap)
+                item = self._items.get(token)
+                if item is not None and item[0] == expires:
+                    del self._items[token]
+                    removed += 1
+            if len(self._heap) > 2 * len(self._items) + 64:
+                self._heap = [(item[0], t) for t, item in self._items.items()]
+                heapq.heapify(self._heap)
+            metric_set(f"pending_{self.kind}_size", len(self._items))
+
+        metric_inc(f"pending_{self.kind}_expired", removed)
+        return removed
+
+
+pending_transfers = PendingStore("transfer", TRANSFER_CONFIRM_TTL + PENDING_GRACE)
+pending_resets = PendingStore("reset", RESET_CONFIRM_TTL + PENDING_GRACE)
+_pending_sweep_task: asyncio.Task | None = None
+
+
+async def pending_sweep_loop():
+    while True:
+        await asyncio.sleep(PENDING_SWEEP_INTERVAL)
+        for store in (pending_transfers, pending_resets):
+            try:
+                await store.sweep()
+            except Exception as e:
+                logging.warning(f"Pending sweep failed ({store.kind}): {e}")
+
+
+# points_ledger пишется в той же транзакции, что и баланс: журнал не теряет и не опережает изменения.
+# kind — admin / mass / transfer_out / transfer_in / reset, balance — баланс после изменения.
+LEDGER_COLUMNS = ("chat_id", "user_id", "actor_id", "delta", "balance", "kind", "reason")
+
+
+async def copy_ledger(conn, records: List[tuple]):
+    """
+    Пачка записей журнала через COPY. Вызывать внутри транзакции, изменившей баллы.
+    """
+    if not records:
+        return
+    await conn.copy_records_to_table("points_ledger", records=records, columns=LEDGER_COLUMNS)
+    metric_inc("ledger_rows", len(records))
+
+
+# самые частые запросы готовим заранее на каждом соединении пула (см. BotConnection)
+# в top_after/top_before условие «points <= / >= курсора» избыточно, но только оно даёт планировщику
+# границу по индексу (chat_id, points DESC, join_seq): без него скан шёл с начала чата, как OFFSET
+HOT_STATEMENTS = {
+    "points": "SELECT points FROM users WHERE user_id = $1 AND chat_id = $2",
+    "upsert_user": """
+        INSERT INTO users (user_id, chat_id, points, name, username)
+        VALUES ($1, $2, $3, $4, $5)
+        ON CONFLICT (user_id, chat_id)
+        DO UPDATE SET
+            name = EXCLUDED.name,
+            username = COALESCE(EXCLUDED.username, users.username)
+        RETURNING points, join_seq, username, (xmax = 0) AS inserted
+    """,
+    "chat_admins": "SELECT user_id, MAX(level) AS level FROM admins WHERE chat_id = $1 GROUP BY user_id",
+    "top_page": (
+        "SELECT user_id, name, points, username, join_seq FROM users "
+        "WHERE chat_id = $1 ORDER BY points DESC, join_seq ASC LIMIT $2 OFFSET $3"
+    ),
+    "top_after": (
+        "SELECT user_id, name, points, username, join_seq FROM users "
+        "WHERE chat_id = $1 AND points <= $2 AND (points < $2 OR (points = $2 AND join_seq > $3)) "
+        "ORDER BY points DESC, join_seq ASC LIMIT $4"
+    ),
+    "top_before": (
+        "SELECT user_id, name, points, username, join_seq FROM users "
+        "WHERE chat_id = $1 AND points >= $2 AND (points > $2 OR (points = $2 AND join_seq < $3)) "
+        "ORDER BY points ASC, join_seq DESC LIMIT $4"
+    ),
+}
+
+
+class BotConnection(asyncpg.Connection):
+    """
+    Соединение пула с заранее подготовленными HOT_STATEMENTS.
+    Сброс соединения при возврате в пул (RESET ALL / CLOSE ALL) их не удаляет,
+    так что готовим один раз — при открытии соединения.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.hot: Dict[str, asyncpg.prepared_stmt.PreparedStatement] = {}
+
+
+async def prepare_hot_statements(conn: BotConnection):
+    for name, sql in HOT_STATEMENTS.items():
+        conn.hot[name] = await conn.prepare(sql)
+
+
+class UpdateConnection:
+    __slots__ = ("task", "conn", "depth")
+
+    def __init__(self, task: asyncio.Task | None):
+        self.task = task
+        self.conn = None
+        self.depth = 0
+
+
+# соединение текущего апдейта; заполняет DbConnectionMiddleware
+_update_conn: ContextVar[Optional[UpdateConnection]] = ContextVar("update_conn", default=None)
+
+
+async def _acquire_timed():
+    started = time.monotonic()
+    conn = await pool.acquire()
+    waited = (time.monotonic() - started) * 1000
+    metric_inc("db_acquires")
+    metric_inc("db_pool_wait_ms_total", waited)
+    metric_max("db_pool_wait_ms_max", waited)
+    return conn
+
+
+@asynccontextmanager
+async def db_conn():
+    """
+    Соединение для запроса. Внутри апдейта вложенные db_conn() получают то же соединение,
+    что и внешний, — одному апдейту никогда не нужно два соединения.
+    Соединение берётся при первом обращении и возвращается в пул, как только закрылся внешний блок,
+    так что на время запросов к Telegram оно не удерживается.
+    Дочерние задачи (create_task/gather) видят тот же контекст, но соединение не делят — берут своё.
+    """
+    holder = _update_conn.get()
+    if holder is None or holder.task is not asyncio.current_task():
+        conn = await _acquire_timed()
+        try:
+            yield conn
+        finally:
+            await pool.release(conn)
+        return
+
+    if holder.conn is None:
+        holder.conn = await _acquire_timed()
+    else:
+        metric_inc("db_conn_reused")
+    holder.depth += 1
+    try:
+        yield holder.conn
+    finally:
+        holder.depth -= 1
+        if holder.depth == 0:
+            conn, holder.conn = holder.conn, None
+            await pool.release(conn)
+
+
+class DbConnectionMiddleware(BaseMiddleware):
+    async def __call__(
+        self,
+        handler: Callable[[types.TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: types.TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        token = _update_conn.set(UpdateConnection(asyncio.current_task()))
+        try:
+            return await handler(event, data)
+        finally:
+            _update_conn.reset(token)
+
+
+async def fetch_points(conn, user_id: int, chat_id: int) -> int | None:
+    return await conn.hot["points"].fetchval(user_id, chat_id)
+
+
 async def init_db():
     global pool
-    pool = await asyncpg.create_pool(DATABASE_URL)
-    async with pool.acquire() as conn:
+    # схема — отдельным соединением: пулу для подготовки запросов нужны уже готовые таблицы
+    conn = await asyncpg.connect(DATABASE_URL)
+    try:
         await conn.execute("CREATE SEQUENCE IF NOT EXISTS users_join_seq")
         await conn.execute("""
         CREATE TABLE IF NOT EXISTS users (
@@ -452,6 +1246,13 @@ async def init_db():
         WHERE u.user_id = n.user_id AND u.chat_id = n.chat_id
         """)
 
+        await conn.execute(
+            "CREATE INDEX IF NOT EXISTS users_chat_points_idx ON users (chat_id, points DESC, join_seq)"
+        )
+        await conn.execute("CREATE INDEX IF NOT EXISTS users_chat_user_idx ON users (chat_id, user_id)")
+        await conn.execute("CREATE INDEX IF NOT EXISTS users_chat_username_idx ON users (chat_id, username)")
+        await conn.execute("CREATE INDEX IF NOT EXISTS users_username_idx ON users (username)")
+
         await conn.execute("""
         CREATE TABLE IF NOT EXISTS chat_settings (
             chat_id BIGINT PRIMARY KEY,
@@ -469,6 +1270,19 @@ async def init_db():
         )
         """)
 
+        if PENDING_BACKEND == "postgres":
+            await conn.execute("""
+            CREATE TABLE IF NOT EXISTS pending_confirmations (
+                token TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                payload JSONB NOT NULL,
+                expires_at TIMESTAMPTZ NOT NULL
+            )
+            """)
+            await conn.execute(
+                "CREATE INDEX IF NOT EXISTS pending_confirmations_expires_idx ON pending_confirmations (expires_at)"
+            )
+
         await conn.execute("""
         CREATE TABLE IF NOT EXISTS chat_emojis (
             chat_id BIGINT NOT NULL,
@@ -511,6 +1325,23 @@ async def init_db():
         except Exception:
             pass
 
+        # только дописываем: строки не меняются, поэтому BRIN по времени почти бесплатен
+        await conn.execute("""
+        CREATE TABLE IF NOT EXISTS points_ledger (
+            chat_id BIGINT NOT NULL,
+            user_id BIGINT NOT NULL,
+            actor_id BIGINT,
+            delta INT NOT NULL,
+            balance INT NOT NULL,
+            kind TEXT NOT NULL,
+            reason TEXT,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+        """)
+        await conn.execute(
+            "CREATE INDEX IF NOT EXISTS points_ledger_created_brin ON points_ledger USING BRIN (created_at)"
+        )
+
         await conn.execute("""
         UPDATE users u
         SET points = cs.join_points
@@ -523,11 +1354,92 @@ async def init_db():
         SET points = 50
         WHERE points = 0
         """)
+    finally:
+        await conn.close()
+
+    pool = await asyncpg.create_pool(
+        DATABASE_URL,
+        min_size=DB_POOL_MIN,
+        max_size=DB_POOL_MAX,
+        max_inactive_connection_lifetime=DB_MAX_INACTIVE_LIFETIME,
+        command_timeout=DB_COMMAND_TIMEOUT,
+        statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+        connection_class=BotConnection,
+        init=prepare_hot_statements
+    )
+
+
+@dataclass
+class ChatSettings:
+    join_points: int
+    rating_text: str | None
+    version: int
+    loaded: float
+
+
+_chat_settings: Dict[int, ChatSettings] = {}
+_settings_version = 0
+_settings_generation = 0
+
+
+def _store_chat_settings(chat_id: int, join_points: int, rating_text: str | None) -> ChatSettings:
+    global _settings_version
+    _settings_version += 1
+    cs = ChatSettings(
+        join_points=int(join_points),
+        rating_text=rating_text,
+        version=_settings_version,
+        loaded=time.monotonic()
+    )
+    _chat_settings[chat_id] = cs
+    return cs
+
+
+def invalidate_chat_settings(chat_id: int | None = None):
+    global _settings_generation
+    _settings_generation += 1
+    if chat_id is None:
+        _chat_settings.clear()
+    else:
+        _chat_settings.pop(chat_id, None)
+
+
+async def get_chat_settings(chat_id: int) -> ChatSettings:
+    """
+    Настройки чата из памяти; в базу ходим только при промахе или по истечении CHAT_SETTINGS_TTL.
+    """
+    cs = _chat_settings.get(chat_id)
+    if cs and time.monotonic() - cs.loaded < CHAT_SETTINGS_TTL:
+        metric_inc("settings_cache_hit")
+        return cs
+
+    metric_inc("settings_cache_miss")
+    generation = _settings_generation
+    async with db_conn() as conn:
+        row = await conn.fetchrow(
+            "SELECT join_points, rating_text FROM chat_settings WHERE chat_id = $1",
+            chat_id
+        )
+        if row is None:
+            await conn.execute(
+                "INSERT INTO chat_settings (chat_id, join_points) VALUES ($1, 50) ON CONFLICT (chat_id) DO NOTHING",
+                chat_id
+            )
+            jp, txt = 50, None
+        else:
+            jp, txt = row["join_points"], row["rating_text"]
+
+    if generation != _settings_generation:
+        # пока читали, настройки успели поменять — не кэшируем устаревшее
+        return ChatSettings(join_points=int(jp), rating_text=txt, version=0, loaded=0.0)
+    return _store_chat_settings(chat_id, jp, txt)
 
 
 async def ensure_chat_settings(chat_id: int):
-    async with pool.acquire() as conn:
-        await conn.execute(
+    if chat_id in _chat_settings:
+        return
+    async with db_conn() as conn:
+        status = await conn.execute(
             """
             INSERT INTO chat_settings (chat_id, join_points)
             VALUES ($1, 50)
@@ -535,79 +1447,610 @@ async def ensure_chat_settings(chat_id: int):
             """,
             chat_id
         )
+    if status != "INSERT 0 0":
+        invalidate_chat_settings(chat_id)
+
+
+async def get_join_points(chat_id: int) -> int:
+    return (await get_chat_settings(chat_id)).join_points
+
+
+async def get_rating_text(chat_id: int) -> str:
+    txt = (await get_chat_settings(chat_id)).rating_text
+    txt = str(txt).strip() if txt is not None else ""
+    return txt if txt else RATING_INFO_TEXT
+
+
+async def set_rating_text(chat_id: int, new_text: str):
+    new_text = (new_text or "").strip()
+    async with db_conn() as conn:
+        row = await conn.fetchrow(
+            "INSERT INTO chat_settings (chat_id, join_points, rating_text) VALUES ($1, 50, $2) "
+            "ON CONFLICT (chat_id) DO UPDATE SET rating_text = EXCLUDED.rating_text "
+            "RETURNING join_points, rating_text",
+            chat_id,
+            new_text
+        )
+        await notify_invalidate(conn, "settings", chat_id)
+    invalidate_chat_settings(chat_id)
+    _store_chat_settings(chat_id, row["join_points"], row["rating_text"])
+
+
+async def set_join_points(chat_id: int, join_points: int):
+    async with db_conn() as conn:
+        row = await conn.fetchrow("""
+            INSERT INTO chat_settings (chat_id, join_points)
+            VALUES ($1, $2)
+            ON CONFLICT (chat_id)
+            DO UPDATE SET join_points = $2
+            RETURNING join_points, rating_text
+        """, chat_id, join_points)
+        await notify_invalidate(conn, "settings", chat_id)
+    invalidate_chat_settings(chat_id)
+    _store_chat_settings(chat_id, row["join_points"], row["rating_text"])
+
+
+_member_cache: "OrderedDict[Tuple[int, int], Tuple[str, str | None, float]]" = OrderedDict()
+
+
+def member_cache_get(user_id: int, chat_id: int) -> Optional[Tuple[str, str | None]]:
+    """
+    LRU/TTL-кэш профилей: (user_id, chat_id) -> (name, username).
+    Запись в кэше означает, что строка в users уже есть.
+    """
+    key = (user_id, chat_id)
+    item = _member_cache.get(key)
+    if item is None:
+        metric_inc("member_cache_miss")
+        return None
+    if time.monotonic() - item[2] > MEMBER_CACHE_TTL:
+        del _member_cache[key]
+        metric_inc("member_cache_miss")
+        return None
+    _member_cache.move_to_end(key)
+    metric_inc("member_cache_hit")
+    return item[0], item[1]
+
+
+def member_cache_put(user_id: int, chat_id: int, name: str, username: str | None):
+    key = (user_id, chat_id)
+    _member_cache[key] = (name, username, time.monotonic())
+    _member_cache.move_to_end(key)
+    while len(_member_cache) > MEMBER_CACHE_SIZE:
+        _member_cache.popitem(last=False)
+        metric_inc("member_cache_evicted")
+    metric_set("member_cache_size", len(_member_cache))
+
+
+def member_is_fresh(user_id: int, chat_id: int, name: str, username: str | None) -> bool:
+    cached = member_cache_get(user_id, chat_id)
+    if cached is None:
+        return False
+    return cached[0] == name and (not username or cached[1] == username)
+
+
+_username_cache: "OrderedDict[Tuple[int, str], Tuple[int, str, float]]" = OrderedDict()
+# обратная сторона: (chat_id, user_id) -> username, под которым участник сейчас лежит в _username_cache
+_username_of: Dict[Tuple[int, int], str] = {}
+
+
+def _username_cache_drop(key: Tuple[int, str]):
+    item = _username_cache.pop(key, None)
+    if item is not None and _username_of.get((key[0], item[0])) == key[1]:
+        del _username_of[(key[0], item[0])]
+
+
+def username_cache_get(chat_id: int, username: str) -> Optional[Tuple[int, str]]:
+    """
+    @username в чате -> (user_id, name). Заполняется из записей в users, поэтому
+    упоминания активных участников разрешаются без запроса к базе.
+    Попадание отдаём, только если это всё ещё текущий username участника.
+    """
+    key = (chat_id, username)
+    item = _username_cache.get(key)
+    if item is None or time.monotonic() - item[2] > USERNAME_CACHE_TTL:
+        metric_inc("username_cache_miss")
+        return None
+
+    user_id = item[0]
+    profile = member_cache_get(user_id, chat_id)
+    if _username_of.get((chat_id, user_id)) != username or (profile and profile[1] and profile[1] != username):
+        _username_cache_drop(key)
+        metric_inc("username_cache_stale")
+        return None
+
+    _username_cache.move_to_end(key)
+    metric_inc("username_cache_hit")
+    return user_id, item[1]
+
+
+def username_cache_put(chat_id: int, username: str | None, user_id: int, name: str):
+    """
+    Сменил username — старый ключ убираем сразу: освободившийся ник может занять другой участник.
+    """
+    prev = _username_of.get((chat_id, user_id))
+    if prev is not None and prev != username:
+        _username_cache_drop((chat_id, prev))
+    if not username:
+        return
+
+    key = (chat_id, username)
+    owner = _username_cache.get(key)
+    if owner is not None and owner[0] != user_id:
+        _username_cache_drop(key)
+    _username_cache[key] = (user_id, name, time.monotonic())
+    _username_cache.move_to_end(key)
+    _username_of[(chat_id, user_id)] = username
+    while len(_username_cache) > USERNAME_CACHE_SIZE:
+        _username_cache_drop(next(iter(_username_cache)))
+
+
+async def update_user_data(user_id: int, chat_id: int, name: str, username: str | None = None):
+    if username:
+        username = username.replace("@", "").lower()
+
+    # синхронная запись свежее отложенной — отложенную выкидываем
+    _member_buffer.pop((user_id, chat_id), None)
+
+    if member_is_fresh(user_id, chat_id, name, username):
+        return
+
+    join_points = await get_join_points(chat_id)
+
+    async with db_conn() as conn:
+        row = await conn.hot["upsert_user"].fetchrow(user_id, chat_id, join_points, name, username)
+
+    member_cache_put(user_id, chat_id, name, username)
+    on_member_saved(chat_id, user_id, row["points"], row["join_seq"], name, row["username"], row["inserted"])
+
+
+_member_buffer: Dict[Tuple[int, int], Tuple[str, str | None]] = {}
+# пачка, которую flush_member_buffer пишет прямо сейчас: её уже нет в буфере, но ещё нет в базе
+_member_inflight: Dict[Tuple[int, int], Tuple[str, str | None]] = {}
+_member_flush_lock = asyncio.Lock()
+_member_flush_wakeup = asyncio.Event()
+_member_flush_task: asyncio.Task | None = None
+
+
+def queue_user_data(user_id: int, chat_id: int, name: str, username: str | None = None):
+    """
+    Отложенная запись имени/юзернейма (write-behind).
+    Повторы по (user_id, chat_id) схлопываются, в базу уходит пачкой раз в MEMBER_FLUSH_INTERVAL.
+    """
+    if username:
+        username = username.replace("@", "").lower()
+
+    key = (user_id, chat_id)
+    if member_is_fresh(user_id, chat_id, name, username):
+        _member_buffer.pop(key, None)
+        metric_inc("member_buffer_noop")
+        return
+
+    prev = _member_buffer.get(key)
+    if prev is not None and not username:
+        username = prev[1]
+
+    value = (name, username)
+    if prev == value:
+        metric_inc("member_buffer_noop")
+        return
+
+    _member_buffer[key] = value
+    metric_inc("member_buffer_queued")
+    if len(_member_buffer) >= MEMBER_FLUSH_MAX_BATCH:
+        _member_flush_wakeup.set()
+
+
+async def flush_member_buffer():
+    global _member_buffer, _member_inflight
+    async with _member_flush_lock:
+        if not _member_buffer:
+            return
+        batch, _member_buffer = _member_buffer, {}
+        _member_inflight = batch
+        items = list(batch.items())
+
+        started = time.perf_counter()
+        try:
+            async with db_conn() as conn:
+                saved = []
+                for i in range(0, len(items), MEMBER_FLUSH_MAX_BATCH):
+                    chunk = items[i:i + MEMBER_FLUSH_MAX_BATCH]
+                    saved += await conn.fetch("""
+                    INSERT INTO users (user_id, chat_id, points, name, username)
+                    SELECT b.user_id, b.chat_id, COALESCE(cs.join_points, 50), b.name, b.username
+                    FROM unnest($1::bigint[], $2::bigint[], $3::text[], $4::text[])
+                        AS b(user_id, chat_id, name, username)
+                    LEFT JOIN chat_settings cs ON cs.chat_id = b.chat_id
+                    ON CONFLICT (user_id, chat_id)
+                    DO UPDATE SET
+                        name = EXCLUDED.name,
+                        username = COALESCE(EXCLUDED.username, users.username)
+                    WHERE users.name IS DISTINCT FROM EXCLUDED.name
+                       OR (EXCLUDED.username IS NOT NULL AND users.username IS DISTINCT FROM EXCLUDED.username)
+                    RETURNING user_id, chat_id, points, join_seq, name, username, (xmax = 0) AS inserted
+                    """,
+                        [k[0] for k, _ in chunk],
+                        [k[1] for k, _ in chunk],
+                        [v[0] for _, v in chunk],
+                        [v[1] for _, v in chunk]
+                    )
+        except asyncio.CancelledError:
+            for k, v in items:
+                _member_buffer.setdefault(k, v)
+            raise
+        except Exception as e:
+            logging.warning(f"Member flush failed ({len(items)} rows): {e}")
+            metric_inc("member_flush_errors")
+            # более свежие значения, пришедшие во время записи, не затираем
+            for k, v in items:
+                _member_buffer.setdefault(k, v)
+            return
+        finally:
+            _member_inflight = {}
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        for (uid, cid), (name, username) in items:
+            member_cache_put(uid, cid, name, username)
+        for r in saved:
+            on_member_saved(
+                r["chat_id"], r["user_id"], r["points"], r["join_seq"], r["name"], r["username"], r["inserted"]
+            )
+
+        metric_inc("member_flush_total")
+        metric_inc("member_flush_rows", len(items))
+        metric_set("member_flush_last_batch", len(items))
+        metric_max("member_flush_max_batch", len(items))
+        metric_set("member_flush_last_ms", round(elapsed_ms, 2))
+        metric_max("member_flush_max_ms", round(elapsed_ms, 2))
+
+
+def find_pending_member(chat_id: int, username: str) -> Optional[Tuple[int, int]]:
+    """
+    (user_id, chat_id) участника с таким юзернеймом, который ждёт отложенной записи;
+    строка этого чата важнее строк из других. Буфер — не больше пачки, перебор дешёвый.
+    """
+    found = None
+    for pending in (_member_buffer, _member_inflight):
+        for key, (_, uname) in pending.items():
+            if uname != username:
+                continue
+            if key[1] == chat_id:
+                return key
+            found = found or key
+    return found
+
+
+async def save_pending_member(user_id: int, chat_id: int) -> bool:
+    """
+    Если участник ещё лежит в отложенной записи — пишем только его, сразу. True — было что писать.
+    """
+    key = (user_id, chat_id)
+    value = _member_buffer.get(key) or _member_inflight.get(key)
+    if value is None:
+        return False
+    metric_inc("member_buffer_sync_writes")
+    await update_user_data(user_id, chat_id, value[0], value[1])
+    return True
+
+
+async def member_flush_loop():
+    while True:
+        try:
+            await asyncio.wait_for(_member_flush_wakeup.wait(), MEMBER_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        _member_flush_wakeup.clear()
+        try:
+            await flush_member_buffer()
+        except Exception as e:
+            logging.warning(f"Member flush loop error: {e}")
+
+
+class Leaderboard:
+    """
+    Верх топа одного чата: первые LEADERBOARD_WINDOW участников в порядке points DESC, join_seq ASC.
+    Окно — всегда точный префикс топа; complete — в него попал весь чат.
+    keys — отсортированный список (-points, join_seq, user_id) через bisect: вставка O(окна),
+    но окно ограничено сотнями записей, и сдвиг такого списка дешевле любого дерева на Python.
+    """
+    __slots__ = ("keys", "members", "loaded", "complete")
+
+    def __init__(self, rows, complete: bool):
+        # user_id -> [points, join_seq, name, username]
+        self.members: Dict[int, list] = {}
+        for r in rows:
+            self.members[int(r["user_id"])] = [
+                int(r["points"] or 0), int(r["join_seq"] or 0), r["name"], r["username"]
+            ]
+        self.keys: List[Tuple[int, int, int]] = sorted(
+            (-m[0], m[1], uid) for uid, m in self.members.items()
+        )
+        self.complete = complete
+        self.loaded = time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self.members)
+
+    def _fits(self, key: Tuple[int, int, int]) -> bool:
+        # выше последнего места окна — значит, точно в префиксе; ниже — там может быть кто угодно из базы
+        return self.complete or (bool(self.keys) and key < self.keys[-1])
+
+    def _unlink(self, user_id: int, m: list):
+        key = (-m[0], m[1], user_id)
+        i = bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            del self.keys[i]
+
+    def _link(self, user_id: int, m: list):
+        insort(self.keys, (-m[0], m[1], user_id))
+        while len(self.keys) > LEADERBOARD_WINDOW:
+            _, _, uid = self.keys.pop()
+            del self.members[uid]
+            self.complete = False
+
+    def upsert(self, user_id: int, points: int, join_seq: int, name: str, username: str | None) -> bool:
+        """
+        False — окно больше нельзя считать точным (его надо перечитать).
+        """
+        m = self.members.get(user_id)
+        if m is not None:
+            m[2], m[3] = name, username
+            return self.set_points(user_id, points)
+        m = [int(points), int(join_seq or 0), name, username]
+        if self._fits((-m[0], m[1], user_id)):
+            self.members[user_id] = m
+            self._link(user_id, m)
+        return True
+
+    def set_points(self, user_id: int, points: int) -> bool:
+        m = self.members.get(user_id)
+        if m is None:
+            # участник вне окна: если он поднялся в окно, его строки у нас нет
+            return not self._fits((-int(points), 0, user_id))
+        if m[0] == points:
+            return True
+        self._unlink(user_id, m)
+        m[0] = int(points)
+        if self._fits((-m[0], m[1], user_id)):
+            self._link(user_id, m)
+        else:
+            # опустился ниже окна — окно просто становится короче, но остаётся точным
+            del self.members[user_id]
+        return True
+
+    def points_of(self, user_id: int) -> Optional[int]:
+        m = self.members.get(user_id)
+        return m[0] if m is not None else None
+
+    def covers(self, offset: int, limit: int) -> bool:
+        return self.complete or offset + limit <= len(self.keys)
+
+    def page(self, offset: int, limit: int) -> list:
+        out = []
+        for _, seq, uid in self.keys[offset:offset + limit]:
+            m = self.members[uid]
+            out.append({"user_id": uid, "name": m[2], "points": m[0], "username": m[3], "join_seq": seq})
+        return out
+
+
+class PointsHistogram:
+    """
+    Сколько участников чата на каждом значении баллов BALANCE_MIN..BALANCE_MAX.
+    Место и общее число считаются префиксной суммой по 101 счётчику, без COUNT(*).
+    """
+    __slots__ = ("counts", "loaded")
+
+    def __init__(self):
+        self.counts = [0] * (BALANCE_MAX - BALANCE_MIN + 1)
+        self.loaded = time.monotonic()
+
+    @staticmethod
+    def _bucket(points: int) -> int:
+        return min(max(int(points), BALANCE_MIN), BALANCE_MAX) - BALANCE_MIN
+
+    def add(self, points: int, n: int = 1):
+        self.counts[self._bucket(points)] += n
+
+    def move(self, old_points: int, new_points: int):
+        old_b, new_b = self._bucket(old_points), self._bucket(new_points)
+        if old_b != new_b:
+            self.counts[old_b] = max(0, self.counts[old_b] - 1)
+            self.counts[new_b] += 1
+
+    def rank(self, points: int) -> Tuple[int, int]:
+        """(сколько строго выше, сколько всего)"""
+        return sum(self.counts[self._bucket(points) + 1:]), sum(self.counts)
+
+
+_points_hist: Dict[int, PointsHistogram] = {}
+
+
+async def rebuild_points_histograms():
+    async with db_conn() as conn:
+        rows = await conn.fetch("SELECT chat_id, points, COUNT(*) AS n FROM users GROUP BY chat_id, points")
+
+    hists: Dict[int, PointsHistogram] = {}
+    for r in rows:
+        h = hists.get(r["chat_id"])
+        if h is None:
+            h = hists[r["chat_id"]] = PointsHistogram()
+        h.add(r["points"] or 0, int(r["n"]))
+    _points_hist.clear()
+    _points_hist.update(hists)
+    metric_set("points_hist_chats", len(_points_hist))
+
+
+async def get_points_histogram(chat_id: int) -> PointsHistogram:
+    """
+    Гистограмма чата; раз в POINTS_HIST_TTL перечитывается из базы, чтобы сойтись с другими репликами.
+    """
+    h = _points_hist.get(chat_id)
+    if h is not None and time.monotonic() - h.loaded < POINTS_HIST_TTL:
+        return h
+
+    metric_inc("points_hist_loads")
+    async with db_conn() as conn:
+        rows = await conn.fetch(
+            "SELECT points, COUNT(*) AS n FROM users WHERE chat_id = $1 GROUP BY points",
+            chat_id
+        )
+    h = PointsHistogram()
+    for r in rows:
+        h.add(r["points"] or 0, int(r["n"]))
+    _points_hist[chat_id] = h
+    return h
+
+
+_leaderboards: "OrderedDict[int, Leaderboard]" = OrderedDict()
+_leaderboard_loads: Dict[int, asyncio.Future] = {}
+_leaderboard_dirty: set = set()
+
+
+async def _load_leaderboard(chat_id: int) -> Optional[Leaderboard]:
+    metric_inc("leaderboard_loads")
+    _leaderboard_dirty.discard(chat_id)
+    async with db_conn() as conn:
+        rows = await conn.fetch(
+            "SELECT user_id, points, join_seq, name, username FROM users WHERE chat_id = $1 "
+            "ORDER BY points DESC, join_seq ASC LIMIT $2",
+            chat_id, LEADERBOARD_WINDOW + 1
+        )
 
+    board = Leaderboard(rows[:LEADERBOARD_WINDOW], complete=len(rows) <= LEADERBOARD_WINDOW)
+    if chat_id in _leaderboard_dirty:
+        # пока читали, баллы в чате менялись — снимок мог устареть, не кэшируем
+        _leaderboards.pop(chat_id, None)
+        return board
 
-async def get_join_points(chat_id: int) -> int:
-    async with pool.acquire() as conn:
-        jp = await conn.fetchval("SELECT join_points FROM chat_settings WHERE chat_id = $1", chat_id)
-        if jp is None:
-            await conn.execute(
-                "INSERT INTO chat_settings (chat_id, join_points) VALUES ($1, 50) ON CONFLICT (chat_id) DO NOTHING",
-                chat_id
-            )
-            return 50
-        return int(jp)
+    _leaderboards[chat_id] = board
+    _leaderboards.move_to_end(chat_id)
+    while len(_leaderboards) > LEADERBOARD_CHATS:
+        _leaderboards.popitem(last=False)
+    metric_set("leaderboard_chats", len(_leaderboards))
+    return board
 
 
-async def get_rating_text(chat_id: int) -> str:
-    async with pool.acquire() as conn:
-        txt = await conn.fetchval("SELECT rating_text FROM chat_settings WHERE chat_id = $1", chat_id)
-        if txt is None:
-            await conn.execute(
-                "INSERT INTO chat_settings (chat_id, join_points, rating_text) VALUES ($1, 50, NULL) "
-                "ON CONFLICT (chat_id) DO NOTHING",
-                chat_id
-            )
-            return RATING_INFO_TEXT
-        txt = str(txt).strip()
-        return txt if txt else RATING_INFO_TEXT
+async def get_leaderboard(chat_id: int) -> Optional[Leaderboard]:
+    """
+    Верх топа чата из памяти. None — выключено, тогда читаем топ из базы.
+    Загрузка одного чата не запускается параллельно несколько раз.
+    """
+    if LEADERBOARD_CHATS <= 0:
+        return None
 
+    board = _leaderboards.get(chat_id)
+    if board is not None and time.monotonic() - board.loaded < LEADERBOARD_TTL:
+        _leaderboards.move_to_end(chat_id)
+        metric_inc("leaderboard_hit")
+        return board
 
-async def set_rating_text(chat_id: int, new_text: str):
-    new_text = (new_text or "").strip()
-    async with pool.acquire() as conn:
-        await conn.execute(
-            "INSERT INTO chat_settings (chat_id, join_points, rating_text) VALUES ($1, 50, $2) "
-            "ON CONFLICT (chat_id) DO UPDATE SET rating_text = EXCLUDED.rating_text",
-            chat_id,
-            new_text
-        )
+    fut = _leaderboard_loads.get(chat_id)
+    if fut is None:
+        fut = asyncio.ensure_future(_load_leaderboard(chat_id))
+        _leaderboard_loads[chat_id] = fut
+        fut.add_done_callback(lambda _: _leaderboard_loads.pop(chat_id, None))
+    return await asyncio.shield(fut)
 
 
-async def update_user_data(user_id: int, chat_id: int, name: str, username: str | None = None):
-    if username:
-        username = username.replace("@", "").lower()
+def _touch_leaderboard(chat_id: int) -> Optional[Leaderboard]:
+    if chat_id in _leaderboard_loads:
+        _leaderboard_dirty.add(chat_id)
+    return _leaderboards.get(chat_id)
 
-    join_points = await get_join_points(chat_id)
 
-    async with pool.acquire() as conn:
-        await conn.execute("""
-        INSERT INTO users (user_id, chat_id, points, name, username)
-        VALUES ($1, $2, $3, $4, $5)
-        ON CONFLICT (user_id, chat_id)
-        DO UPDATE SET
-            name = EXCLUDED.name,
-            username = COALESCE(EXCLUDED.username, users.username)
-        """, user_id, chat_id, join_points, name, username)
+def _drop_leaderboard(chat_id: int):
+    # перечитается при следующем показе топа — один короткий запрос по индексу
+    _leaderboards.pop(chat_id, None)
+    metric_inc("leaderboard_invalidated")
+
+
+def on_member_saved(
+    chat_id: int,
+    user_id: int,
+    points: int,
+    join_seq: int,
+    name: str,
+    username: str | None,
+    inserted: bool
+):
+    username_cache_put(chat_id, username, user_id, name)
+    board = _touch_leaderboard(chat_id)
+    if board is not None and not board.upsert(user_id, points, join_seq, name, username):
+        _drop_leaderboard(chat_id)
+    if inserted:
+        h = _points_hist.get(chat_id)
+        if h is not None:
+            h.add(points)
+
+
+def on_points_changed(chat_id: int, user_id: int, old_points: int, new_points: int):
+    """
+    Вызывать после каждой записи users.points — держит в синхроне структуры в памяти.
+    """
+    board = _touch_leaderboard(chat_id)
+    if board is not None and not board.set_points(user_id, new_points):
+        _drop_leaderboard(chat_id)
+    h = _points_hist.get(chat_id)
+    if h is not None:
+        h.move(old_points, new_points)
 
 
 async def user_exists_in_chat(user_id: int, chat_id: int) -> bool:
-    async with pool.acquire() as conn:
+    if member_cache_get(user_id, chat_id) is not None:
+        return True
+    # впервые замеченный через auto_update может ещё ждать отложенной записи
+    if await save_pending_member(user_id, chat_id):
+        return True
+    async with db_conn() as conn:
         return await conn.fetchval(
             "SELECT 1 FROM users WHERE user_id = $1 AND chat_id = $2",
             user_id, chat_id
         ) is not None
 
 
+_admin_cache: "OrderedDict[int, Tuple[float, Dict[int, int]]]" = OrderedDict()
+_admin_generation = 0
+
+
+def invalidate_admins(chat_id: int | None = None):
+    global _admin_generation
+    _admin_generation += 1
+    if chat_id is None:
+        _admin_cache.clear()
+    else:
+        _admin_cache.pop(chat_id, None)
+
+
+async def get_chat_admins(chat_id: int) -> Dict[int, int]:
+    """
+    Все админы чата одним запросом: user_id -> level.
+    Держим не больше ADMIN_CACHE_CHATS чатов, каждый не дольше ADMIN_CACHE_TTL.
+    """
+    item = _admin_cache.get(chat_id)
+    if item and time.monotonic() - item[0] < ADMIN_CACHE_TTL:
+        _admin_cache.move_to_end(chat_id)
+        metric_inc("admin_cache_hit")
+        return item[1]
+
+    metric_inc("admin_cache_miss")
+    generation = _admin_generation
+    async with db_conn() as conn:
+        rows = await conn.hot["chat_admins"].fetch(chat_id)
+    levels = {int(r["user_id"]): int(r["level"]) for r in rows}
+
+    if generation == _admin_generation:
+        _admin_cache[chat_id] = (time.monotonic(), levels)
+        _admin_cache.move_to_end(chat_id)
+        while len(_admin_cache) > ADMIN_CACHE_CHATS:
+            _admin_cache.popitem(last=False)
+    return levels
+
+
 async def get_admin_level(user_id: int, chat_id: int) -> int:
     if user_id == OWNER_ID:
         return 999
-    async with pool.acquire() as conn:
-        row = await conn.fetchrow(
-            "SELECT level FROM admins WHERE user_id = $1 AND chat_id = $2 ORDER BY level DESC LIMIT 1",
-            user_id, chat_id
-        )
-    return int(row["level"]) if row else 0
+    return (await get_chat_admins(chat_id)).get(user_id, 0)
 
 
 async def has_level(user_id: int, chat_id: int, min_level: int) -> bool:
@@ -615,7 +2058,7 @@ async def has_level(user_id: int, chat_id: int, min_level: int) -> bool:
 
 
 async def set_admin_level(chat_id: int, user_id: int, level: int, mode: str = "force"):
-    async with pool.acquire() as conn:
+    async with db_conn() as conn:
         if mode == "max":
             await conn.execute("""
                 INSERT INTO admins (chat_id, user_id, level)
@@ -630,11 +2073,87 @@ async def set_admin_level(chat_id: int, user_id: int, level: int, mode: str = "f
                 ON CONFLICT (chat_id, user_id)
                 DO UPDATE SET level = EXCLUDED.level
             """, chat_id, user_id, level)
+        await notify_invalidate(conn, "admins", chat_id)
+    invalidate_admins(chat_id)
 
 
 async def remove_admin_level(chat_id: int, user_id: int):
-    async with pool.acquire() as conn:
+    async with db_conn() as conn:
         await conn.execute("DELETE FROM admins WHERE chat_id = $1 AND user_id = $2", chat_id, user_id)
+        await notify_invalidate(conn, "admins", chat_id)
+    invalidate_admins(chat_id)
+
+
+_membership_cache: "OrderedDict[Tuple[int, int], Tuple[bool, float]]" = OrderedDict()
+_membership_loads: Dict[Tuple[int, int], asyncio.Future] = {}
+_membership_generation = 0
+
+
+def _store_membership(chat_id: int, user_id: int, is_member: bool):
+    key = (chat_id, user_id)
+    _membership_cache[key] = (is_member, time.monotonic())
+    _membership_cache.move_to_end(key)
+    while len(_membership_cache) > MEMBERSHIP_CACHE_SIZE:
+        _membership_cache.popitem(last=False)
+
+
+def set_membership(chat_id: int, user_id: int, is_member: bool):
+    """
+    Членство по событию из чата (chat_member, вход/выход) — свежее любого ответа API, что ещё в пути.
+    """
+    global _membership_generation
+    _membership_generation += 1
+    _store_membership(chat_id, user_id, is_member)
+
+
+async def _load_membership(chat_id: int, user_id: int) -> bool:
+    generation = _membership_generation
+    try:
+        member = await bot.get_chat_member(chat_id, user_id)
+    except TelegramBadRequest:
+        # «user not found» и т.п. — ответ окончательный, кэшируем как отрицательный
+        is_member = False
+    except Exception as e:
+        logging.warning(f"get_chat_member failed ({chat_id}, {user_id}): {e}")
+        return False
+    else:
+        is_member = member.status not in ("left", "kicked")
+
+    if generation == _membership_generation:
+        _store_membership(chat_id, user_id, is_member)
+    return is_member
+
+
+async def is_chat_member(chat_id: int, user_id: int) -> bool:
+    """
+    get_chat_member с кэшем: MEMBERSHIP_TTL для «в чате», MEMBERSHIP_NEGATIVE_TTL для «нет».
+    Одновременные проверки одного и того же участника делают один запрос к API.
+    """
+    key = (chat_id, user_id)
+    item = _membership_cache.get(key)
+    if item is not None:
+        ttl = MEMBERSHIP_TTL if item[0] else MEMBERSHIP_NEGATIVE_TTL
+        if time.monotonic() - item[1] < ttl:
+            _membership_cache.move_to_end(key)
+            metric_inc("membership_cache_hit")
+            return item[0]
+
+    metric_inc("membership_cache_miss")
+    fut = _membership_loads.get(key)
+    if fut is None:
+        fut = asyncio.ensure_future(_load_membership(chat_id, user_id))
+        _membership_loads[key] = fut
+        fut.add_done_callback(lambda _: _membership_loads.pop(key, None))
+    return await asyncio.shield(fut)
+
+
+async def _find_user_by_username(chat_id: int, uname: str):
+    async with db_conn() as conn:
+        return await conn.fetchrow(
+            "SELECT user_id, name, username, chat_id = $1 AS in_chat FROM users WHERE username = $2 "
+            "ORDER BY (chat_id = $1) DESC, chat_id DESC, join_seq DESC LIMIT 1",
+            chat_id, uname
+        )
 
 
 async def resolve_target(message: types.Message, args: list):
@@ -651,42 +2170,124 @@ async def resolve_target(message: types.Message, args: list):
     if not uname:
         return None, None, None, "no_target"
 
-    async with pool.acquire() as conn:
-        row = await conn.fetchrow(
-            "SELECT user_id, name, username FROM users WHERE chat_id = $1 AND username = $2",
-            message.chat.id, uname
-        )
-    if row:
-        return row["user_id"], row["name"], row["username"], None
-
-    async with pool.acquire() as conn:
-        row2 = await conn.fetchrow(
-            "SELECT user_id, name, username FROM users WHERE username = $1 ORDER BY chat_id DESC LIMIT 1",
-            uname
-        )
-    if not row2:
+    cached = username_cache_get(message.chat.id, uname)
+    if cached:
+        return cached[0], cached[1], uname, None
+
+    # сначала строка этого чата, иначе — из чата с наибольшим id (как раньше, но одним запросом по индексу)
+    row = await _find_user_by_username(message.chat.id, uname)
+    if not row or not row["in_chat"]:
+        # участник мог попасть только в отложенную запись и ещё не дойти до базы — пишем его одного и ищем снова
+        pending = find_pending_member(message.chat.id, uname)
+        if pending is not None and await save_pending_member(*pending):
+            row = await _find_user_by_username(message.chat.id, uname)
+    if not row:
         return None, None, None, "not_found"
 
-    tid = int(row2["user_id"])
-    tname = row2["name"] or uname
-    tuname = row2["username"]
+    if row["in_chat"]:
+        username_cache_put(message.chat.id, uname, int(row["user_id"]), row["name"])
+        return row["user_id"], row["name"], row["username"], None
 
-    try:
-        member = await bot.get_chat_member(message.chat.id, tid)
-        if member.status in ("left", "kicked"):
-            return None, None, None, "not_in_chat"
-    except Exception:
+    tid = int(row["user_id"])
+    tname = row["name"] or uname
+    tuname = row["username"]
+
+    if not await is_chat_member(message.chat.id, tid):
         return None, None, None, "not_in_chat"
 
     await update_user_data(tid, message.chat.id, tname, tuname)
     return tid, tname, tuname, None
 
 
-async def log_to_owner(text: str):
+_audit_queue: asyncio.Queue = asyncio.Queue(maxsize=AUDIT_QUEUE_MAX)
+_audit_outbox: List[str] = []
+_audit_dropped = 0
+_audit_dropped_digests = 0
+_audit_task: asyncio.Task | None = None
+
+
+def log_to_owner(text: str):
+    """
+    Событие для лога владельцу. Не ждёт отправки: кладём в очередь, audit_loop шлёт сводками.
+    Если очередь полна — событие выкидываем и пишем об этом в следующей сводке.
+    """
+    global _audit_dropped
     try:
-        await bot.send_message(OWNER_ID, text, disable_web_page_preview=True)
-    except Exception as e:
-        logging.warning(f"Failed to send log to owner: {e}")
+        _audit_queue.put_nowait(text)
+    except asyncio.QueueFull:
+        _audit_dropped += 1
+        metric_inc("audit_dropped")
+        return
+    metric_inc("audit_queued")
+    metric_max("audit_queue_max", _audit_queue.qsize())
+
+
+def pack_audit_digests(entries: List[str], dropped: int = 0, dropped_digests: int = 0) -> List[str]:
+    """
+    Склеивает события в сообщения не длиннее TELEGRAM_TEXT_LIMIT.
+    """
+    if dropped_digests:
+        entries = [f"⚠️ Лог долго не доставлялся, пропущено сводок: {dropped_digests}"] + entries
+    if dropped:
+        entries = [f"⚠️ Очередь лога переполнена, пропущено событий: {dropped}"] + entries
+
+    digests = []
+    current = ""
+    for entry in entries:
+        if len(entry) > TELEGRAM_TEXT_LIMIT:
+            entry = entry[:TELEGRAM_TEXT_LIMIT - 1] + "…"
+        if current and len(current) + 2 + len(entry) <= TELEGRAM_TEXT_LIMIT:
+            current += "\n\n" + entry
+            continue
+        if current:
+            digests.append(current)
+        current = entry
+    if current:
+        digests.append(current)
+    return digests
+
+
+async def flush_audit_log() -> bool:
+    """
+    Шлёт накопленные сводки по порядку. Сводка уходит из очереди только после успешной отправки;
+    на первой ошибке останавливаемся и возвращаем False — audit_loop повторит позже.
+    """
+    global _audit_dropped, _audit_dropped_digests
+    entries = []
+    while not _audit_queue.empty():
+        entries.append(_audit_queue.get_nowait())
+    dropped, _audit_dropped = _audit_dropped, 0
+    dropped_digests, _audit_dropped_digests = _audit_dropped_digests, 0
+    _audit_outbox.extend(pack_audit_digests(entries, dropped, dropped_digests))
+
+    overflow = len(_audit_outbox) - AUDIT_OUTBOX_MAX
+    if overflow > 0:
+        del _audit_outbox[:overflow]
+        _audit_dropped_digests += overflow
+        metric_inc("audit_digests_dropped", overflow)
+
+    while _audit_outbox:
+        try:
+            await bot.send_message(OWNER_ID, _audit_outbox[0], disable_web_page_preview=True)
+        except Exception as e:
+            logging.warning(f"Failed to send log to owner: {e}")
+            metric_inc("audit_send_errors")
+            return False
+        metric_inc("audit_digests_sent")
+        _audit_outbox.pop(0)
+    return True
+
+
+async def audit_loop():
+    delay = AUDIT_FLUSH_INTERVAL
+    while True:
+        await asyncio.sleep(delay)
+        try:
+            ok = await flush_audit_log()
+        except Exception as e:
+            logging.warning(f"Audit loop error: {e}")
+            ok = False
+        delay = AUDIT_FLUSH_INTERVAL if ok else min(delay * 2, AUDIT_RETRY_MAX)
 
 
 def extract_reason_from_args(args: list) -> str:
@@ -724,6 +2325,7 @@ def get_role_and_lvl(user_id: int, lvl: int) -> str:
     return "member"
 
 
+@lru_cache(maxsize=4096)
 def main_menu_kb(owner_id: int):
     b = InlineKeyboardBuilder()
     b.button(text="📖 Команды", callback_data=f"menu:{owner_id}:help")
@@ -734,13 +2336,24 @@ def main_menu_kb(owner_id: int):
     return b.as_markup()
 
 
-def get_top_keyboard(current_page: int, total_pages: int, user_id: int):
+def get_top_keyboard(
+    current_page: int,
+    total_pages: int,
+    user_id: int,
+    first: Tuple[int, int] | None = None,
+    last: Tuple[int, int] | None = None
+):
+    """
+    first/last — (points, join_seq) крайних строк страницы: курсор для keyset-пагинации.
+    """
     builder = InlineKeyboardBuilder()
     if current_page > 0:
-        builder.button(text="⬅️", callback_data=f"top:{user_id}:{current_page - 1}")
+        cursor = f":p:{first[0]}:{first[1]}" if first else ""
+        builder.button(text="⬅️", callback_data=f"top:{user_id}:{current_page - 1}{cursor}")
     builder.button(text="🏠 Меню", callback_data=f"menu:{user_id}:main")
     if current_page < total_pages - 1:
-        builder.button(text="➡️", callback_data=f"top:{user_id}:{current_page + 1}")
+        cursor = f":n:{last[0]}:{last[1]}" if last else ""
+        builder.button(text="➡️", callback_data=f"top:{user_id}:{current_page + 1}{cursor}")
     builder.adjust(3)
     return builder.as_markup()
 
@@ -762,22 +2375,16 @@ def reset_confirm_kb(token: str):
 
 
 async def build_my_stats(user_id: int, chat_id: int) -> RichText:
-    async with pool.acquire() as conn:
-        points = await conn.fetchval(
-            "SELECT points FROM users WHERE user_id = $1 AND chat_id = $2",
-            user_id, chat_id
-        )
+    board = _leaderboards.get(chat_id)
+    points = board.points_of(user_id) if board is not None else None
+    if points is None:
+        async with db_conn() as conn:
+            points = await fetch_points(conn, user_id, chat_id)
         if points is None:
             points = await get_join_points(chat_id)
 
-        total = await conn.fetchval("SELECT COUNT(*) FROM users WHERE chat_id = $1", chat_id)
-        higher = await conn.fetchval(
-            "SELECT COUNT(*) FROM users WHERE chat_id = $1 AND points > $2",
-            chat_id, points
-        )
-
-    place = (int(higher) + 1) if higher is not None else 1
-    total = int(total) if total is not None else 0
+    higher, total = (await get_points_histogram(chat_id)).rank(points)
+    place = higher + 1
 
     status = get_point_role(int(points))
     mute_delta, warn_delta = calc_punishment_adjust(int(points))
@@ -790,6 +2397,13 @@ async def build_my_stats(user_id: int, chat_id: int) -> RichText:
     return b
 
 
+def build_main_menu() -> RichText:
+    b = RichText()
+    b.add("💠 ").bold("Меню бота баллов").add("\n")
+    b.add("Выбери раздел кнопками ниже.")
+    return b
+
+
 def build_help(role: str) -> RichText:
     b = RichText()
     b.add("📖 ").bold("Команды бота").add("\n\n")
@@ -823,21 +2437,72 @@ def build_help(role: str) -> RichText:
     if role == "owner":
         b.add("\n").bold("👑 Владельцу").add("\n")
         b.add("• Полный доступ в любом чате\n")
+        b.add("• /метрики | /bmetrics | внутренние счётчики\n")
 
     return b
 
 
-async def send_top_page(message: types.Message, page: int, owner_id: int, edit: bool = False):
+async def count_chat_users(chat_id: int) -> int:
+    """
+    Число участников для «страница X/Y» — из гистограммы баллов чата, без COUNT(*).
+    """
+    return sum((await get_points_histogram(chat_id)).counts)
+
+
+async def fetch_top_rows(
+    conn,
+    chat_id: int,
+    page: int,
+    cursor: Tuple[str, int, int] | None
+) -> Tuple[list, bool]:
+    """
+    Строки страницы топа (points DESC, join_seq ASC) и признак «дальше есть ещё».
+    С курсором из кнопки — seek по индексу (chat_id, points DESC, join_seq), без OFFSET.
+    """
+    if cursor:
+        direction, c_pts, c_seq = cursor
+        if direction == "n":
+            rows = await conn.hot["top_after"].fetch(chat_id, c_pts, c_seq, ITEMS_PER_PAGE + 1)
+            if rows:
+                return rows[:ITEMS_PER_PAGE], len(rows) > ITEMS_PER_PAGE
+        else:
+            rows = await conn.hot["top_before"].fetch(chat_id, c_pts, c_seq, ITEMS_PER_PAGE)
+            if rows:
+                # шли назад от строки курсора — она и всё после неё никуда не делись
+                return list(reversed(rows)), True
+
+    rows = await conn.hot["top_page"].fetch(chat_id, ITEMS_PER_PAGE + 1, page * ITEMS_PER_PAGE)
+    return rows[:ITEMS_PER_PAGE], len(rows) > ITEMS_PER_PAGE
+
+
+async def send_top_page(
+    message: types.Message,
+    page: int,
+    owner_id: int,
+    edit: bool = False,
+    cursor: Tuple[str, int, int] | None = None
+):
     offset = page * ITEMS_PER_PAGE
-    async with pool.acquire() as conn:
-        total_count = await conn.fetchval("SELECT COUNT(*) FROM users WHERE chat_id = $1", message.chat.id)
-        total_pages = max(1, (total_count + ITEMS_PER_PAGE - 1) // ITEMS_PER_PAGE)
-
-        top = await conn.fetch(
-            "SELECT user_id, name, points, username FROM users "
-            "WHERE chat_id = $1 ORDER BY points DESC, join_seq ASC LIMIT $2 OFFSET $3",
-            message.chat.id, ITEMS_PER_PAGE, offset
-        )
+    board = await get_leaderboard(message.chat.id)
+    if board is not None and board.complete:
+        top = board.page(offset, ITEMS_PER_PAGE)
+        total_count = len(board)
+        has_next = offset + ITEMS_PER_PAGE < total_count
+    elif board is not None and board.covers(offset, ITEMS_PER_PAGE):
+        top = board.page(offset, ITEMS_PER_PAGE)
+        # за окном точно кто-то есть; общее число — из гистограммы
+        has_next = True
+        total_count = await count_chat_users(message.chat.id)
+    else:
+        async with db_conn() as conn:
+            top, has_next = await fetch_top_rows(conn, message.chat.id, page, cursor)
+        total_count = await count_chat_users(message.chat.id)
+
+    total_pages = max(1, (total_count + ITEMS_PER_PAGE - 1) // ITEMS_PER_PAGE)
+    if has_next:
+        total_pages = max(total_pages, page + 2)
+    elif top:
+        total_pages = page + 1
 
     if not top:
         b = RichText().add("🔝 Список лидеров пока пуст.")
@@ -864,10 +2529,88 @@ async def send_top_page(message: types.Message, page: int, owner_id: int, edit:
 
         b.add(" | ").bold(pts).add("\n")
 
-    kb = get_top_keyboard(page, total_pages, owner_id)
+    first = (int(top[0]["points"]), int(top[0]["join_seq"]))
+    last = (int(top[-1]["points"]), int(top[-1]["join_seq"]))
+    kb = get_top_keyboard(page, total_pages, owner_id, first=first, last=last)
     await send_rich(message, b, reply_markup=kb, edit=edit)
 
 
+class ChatLane:
+    __slots__ = ("lock", "depth")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.depth = 0
+
+
+class ChatSchedulerMiddleware(BaseMiddleware):
+    """
+    Апдейты одного чата — строго по очереди (asyncio.Lock отдаёт захват в порядке ожидания),
+    разные чаты — параллельно, но не больше UPDATE_CONCURRENCY разом.
+    Глобальный слот берём только когда подошла очередь в своём чате, поэтому
+    хвост одного большого чата не занимает слоты остальных.
+    """
+
+    def __init__(self, concurrency: int):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.lanes: Dict[int, ChatLane] = {}
+        self.queued = 0
+        self.active = 0
+
+    async def _run(self, handler, event, data):
+        async with self.semaphore:
+            self.active += 1
+            metric_set("sched_active", self.active)
+            metric_max("sched_active_max", self.active)
+            try:
+                return await handler(event, data)
+            finally:
+                self.active -= 1
+                metric_set("sched_active", self.active)
+
+    async def __call__(
+        self,
+        handler: Callable[[types.TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: types.TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        chat = data.get("event_chat")
+        if chat is None:
+            return await self._run(handler, event, data)
+
+        lane = self.lanes.get(chat.id)
+        if lane is None:
+            lane = self.lanes[chat.id] = ChatLane()
+            metric_set("sched_lanes", len(self.lanes))
+
+        lane.depth += 1
+        self.queued += 1
+        metric_set("sched_queued", self.queued)
+        metric_max("sched_queued_max", self.queued)
+        metric_max("sched_lane_depth_max", lane.depth)
+        started = time.monotonic()
+        waiting = True
+        try:
+            async with lane.lock:
+                waiting = False
+                self.queued -= 1
+                metric_set("sched_queued", self.queued)
+                metric_max("sched_wait_ms_max", (time.monotonic() - started) * 1000)
+                return await self._run(handler, event, data)
+        finally:
+            if waiting:
+                self.queued -= 1
+                metric_set("sched_queued", self.queued)
+            lane.depth -= 1
+            if lane.depth == 0 and self.lanes.get(chat.id) is lane:
+                del self.lanes[chat.id]
+                metric_set("sched_lanes", len(self.lanes))
+
+
+# после UserContextMiddleware: event_chat уже заполнен
+dp.update.outer_middleware(ChatSchedulerMiddleware(UPDATE_CONCURRENCY))
+dp.update.outer_middleware(DbConnectionMiddleware())
+
 
 @dp.message(Command("start", "bhelp", "бпомощь", "менюб", "menub"))
 async def cmd_menu(message: types.Message):
@@ -877,10 +2620,8 @@ async def cmd_menu(message: types.Message):
         message.from_user.first_name,
         message.from_user.username
     )
-    b = RichText()
-    b.add("💠 ").bold("Меню бота баллов").add("\n")
-    b.add("Выбери раздел кнопками ниже.")
-    await send_rich(message, b, reply_markup=main_menu_kb(message.from_user.id))
+    text, entities = await render_cached(("main",), build_main_menu)
+    await send_rendered(message, text, entities, reply_markup=main_menu_kb(message.from_user.id))
 
 
 @dp.message(Command("эмодзи", "emoji"))
@@ -896,7 +2637,7 @@ async def premium_emoji_cmd(message: types.Message):
     scope_name = "🌍 Глобальные — для всех чатов"
 
     if len(parts) == 1 or (is_global and len(parts) == 2):
-        async with pool.acquire() as conn:
+        async with db_conn() as conn:
             rows = await conn.fetch(
                 "SELECT emoji_text, custom_emoji_id, enabled FROM chat_emojis WHERE chat_id = 0 ORDER BY emoji_text ASC"
             )
@@ -924,56 +2665,53 @@ async def premium_emoji_cmd(message: types.Message):
         return await send_rich(message, b)
 
     if len(parts) < 2 + arg_shift:
-        return await message.reply("❌ Не понял. Напиши: /эмодзи")
+        return post(message.reply("❌ Не понял. Напиши: /эмодзи"))
 
     action = parts[1 + arg_shift].lower()
 
     # удалить все premium-эмодзи сразу
     if action in ("очистить", "сброс", "clear", "wipe", "delall", "removeall"):
-        async with pool.acquire() as conn:
-            await conn.execute("DELETE FROM chat_emojis WHERE chat_id = $1", target_chat_id)
-        global _EMOJI_CACHE
-        _EMOJI_CACHE = None
-        return await message.reply(f"✅ {scope_name}: все premium-эмодзи удалены")
+        await clear_chat_emojis(target_chat_id)
+        return post(message.reply(f"✅ {scope_name}: все premium-эмодзи удалены"))
 
     if len(parts) < 3 + arg_shift:
-        return await message.reply("❌ Не понял. Напиши: /эмодзи")
+        return post(message.reply("❌ Не понял. Напиши: /эмодзи"))
 
     raw_key = parts[2 + arg_shift]
     emoji_keys = [x.strip() for x in raw_key.split("|") if x.strip()]
     if not emoji_keys:
-        return await message.reply("❌ Пустой триггер.")
+        return post(message.reply("❌ Пустой триггер."))
 
     if action in ("сет", "set"):
         if len(parts) < 4 + arg_shift:
-            return await message.reply("Используй: /эмодзи сет «триггеры» «custom_emoji_id»")
+            return post(message.reply("Используй: /эмодзи сет «триггеры» «custom_emoji_id»"))
 
         cid = parts[3 + arg_shift].strip()
         for k in emoji_keys:
             await set_chat_emoji(target_chat_id, k, cid, enabled=True)
-        return await message.reply(f"✅ {scope_name}: {', '.join(emoji_keys)} → {cid}")
+        return post(message.reply(f"✅ {scope_name}: {', '.join(emoji_keys)} → {cid}"))
 
     if action in ("вкл", "on", "enable"):
         for k in emoji_keys:
             await toggle_chat_emoji(target_chat_id, k, True)
-        return await message.reply(f"✅ {scope_name} включено: {', '.join(emoji_keys)}")
+        return post(message.reply(f"✅ {scope_name} включено: {', '.join(emoji_keys)}"))
 
     if action in ("выкл", "off", "disable"):
         for k in emoji_keys:
             await toggle_chat_emoji(target_chat_id, k, False)
-        return await message.reply(f"✅ {scope_name} выключено: {', '.join(emoji_keys)}")
+        return post(message.reply(f"✅ {scope_name} выключено: {', '.join(emoji_keys)}"))
 
     if action in ("дел", "del", "удалить", "remove"):
         for k in emoji_keys:
             await delete_chat_emoji(target_chat_id, k)
-        return await message.reply(f"✅ {scope_name} удалено: {', '.join(emoji_keys)}")
+        return post(message.reply(f"✅ {scope_name} удалено: {', '.join(emoji_keys)}"))
 
-    return await message.reply("❌ Не понял команду. Напиши: /эмодзи")
+    return post(message.reply("❌ Не понял команду. Напиши: /эмодзи"))
 
 @dp.message(F.text.startswith("+рейтинг"))
 async def edit_rating_cmd(message: types.Message):
     if not await has_level(message.from_user.id, message.chat.id, 2) and message.from_user.id != OWNER_ID:
-        return await message.reply("❌ Недостаточно прав. Нужно: админ 2 уровня.")
+        return post(message.reply("❌ Недостаточно прав. Нужно: админ 2 уровня."))
 
     new_text = ""
     if message.reply_to_message and message.reply_to_message.text:
@@ -1003,7 +2741,7 @@ async def menu_handler(callback: types.CallbackQuery):
     owner_id = int(parts[1])
 
     if callback.from_user.id != owner_id:
-        return await callback.answer()
+        return callback.answer()
 
     action = parts[2]
 
@@ -1011,34 +2749,37 @@ async def menu_handler(callback: types.CallbackQuery):
     role = get_role_and_lvl(callback.from_user.id, lvl)
 
     if action == "main":
-        b = RichText()
-        b.add("💠 ").bold("Меню бота баллов").add("\n")
-        b.add("Выбери раздел кнопками ниже.")
-        await send_rich(callback.message, b, reply_markup=main_menu_kb(owner_id), edit=True)
-        return await callback.answer()
+        text, entities = await render_cached(("main",), build_main_menu)
+        await send_rendered(callback.message, text, entities, reply_markup=main_menu_kb(owner_id), edit=True)
+        return callback.answer()
 
     if action == "help":
-        b = build_help(role)
-        await send_rich(callback.message, b, reply_markup=main_menu_kb(owner_id), edit=True)
-        return await callback.answer()
+        text, entities = await render_cached(("help", role), lambda: build_help(role))
+        await send_rendered(callback.message, text, entities, reply_markup=main_menu_kb(owner_id), edit=True)
+        return callback.answer()
 
     if action == "rating":
-        txt = await get_rating_text(callback.message.chat.id)
-        b = RichText().add(txt)
-        await send_rich(callback.message, b, reply_markup=main_menu_kb(owner_id), edit=True)
-        return await callback.answer()
+        chat_id = callback.message.chat.id
+        settings = await get_chat_settings(chat_id)
+        txt = await get_rating_text(chat_id)
+        if settings.version:
+            text, entities = await render_cached(("rating", chat_id, settings.version), lambda: RichText().add(txt))
+        else:
+            text, entities = await render_rich(RichText().add(txt))
+        await send_rendered(callback.message, text, entities, reply_markup=main_menu_kb(owner_id), edit=True)
+        return callback.answer()
 
     if action == "stats":
         b = await build_my_stats(callback.from_user.id, callback.message.chat.id)
         await send_rich(callback.message, b, reply_markup=main_menu_kb(owner_id), edit=True)
-        return await callback.answer()
+        return callback.answer()
 
     if action == "top":
         page = int(parts[3]) if len(parts) > 3 else 0
         await send_top_page(callback.message, page, owner_id=owner_id, edit=True)
-        return await callback.answer()
+        return callback.answer()
 
-    await callback.answer()
+    return callback.answer()
 
 
 @dp.message(Command("стартбаллы", "joinpoints"))
@@ -1057,17 +2798,10 @@ async def set_join_points_cmd(message: types.Message):
     try:
         jp = int(args[1])
     except ValueError:
-        return await message.reply("Введите число. Используй: /стартбаллы 50")
+        return post(message.reply("Введите число. Используй: /стартбаллы 50"))
 
     jp = max(BALANCE_MIN, min(BALANCE_MAX, jp))
-
-    async with pool.acquire() as conn:
-        await conn.execute("""
-            INSERT INTO chat_settings (chat_id, join_points)
-            VALUES ($1, $2)
-            ON CONFLICT (chat_id)
-            DO UPDATE SET join_points = $2
-        """, message.chat.id, jp)
+    await set_join_points(message.chat.id, jp)
 
     b = RichText().add("✅ Стартовые баллы установлены на ").bold(jp).add(".")
     await send_rich(message, b)
@@ -1076,11 +2810,8 @@ async def set_join_points_cmd(message: types.Message):
 @dp.message(Command("моиб", "myb"))
 async def my_points(message: types.Message):
     await update_user_data(message.from_user.id, message.chat.id, message.from_user.first_name, message.from_user.username)
-    async with pool.acquire() as conn:
-        points = await conn.fetchval(
-            "SELECT points FROM users WHERE user_id = $1 AND chat_id = $2",
-            message.from_user.id, message.chat.id
-        )
+    async with db_conn() as conn:
+        points = await fetch_points(conn, message.from_user.id, message.chat.id)
     if points is None:
         points = await get_join_points(message.chat.id)
 
@@ -1101,20 +2832,17 @@ async def check_stats(message: types.Message):
 
     tid, tname, tuname, err = await resolve_target(message, message.text.split())
     if err == "no_target":
-        return await message.reply("⚠️ Укажи @username или ответь на сообщение.")
+        return post(message.reply("⚠️ Укажи @username или ответь на сообщение."))
     if err == "not_found":
-        return await message.reply("❌ Пользователь не найден. Пусть он напишет сообщение в любой чат с ботом.")
+        return post(message.reply("❌ Пользователь не найден. Пусть он напишет сообщение в любой чат с ботом."))
     if err == "not_in_chat":
-        return await message.reply("❌ Этот @username не найден среди участников этого чата.")
+        return post(message.reply("❌ Этот @username не найден среди участников этого чата."))
 
     if not await user_exists_in_chat(tid, message.chat.id):
-        return await message.reply("❌ Пользователь не найден в базе этого чата.\nПусть он напишет сообщение.")
+        return post(message.reply("❌ Пользователь не найден в базе этого чата.\nПусть он напишет сообщение."))
 
-    async with pool.acquire() as conn:
-        points = await conn.fetchval(
-            "SELECT points FROM users WHERE user_id = $1 AND chat_id = $2",
-            tid, message.chat.id
-        )
+    async with db_conn() as conn:
+        points = await fetch_points(conn, tid, message.chat.id)
     if points is None:
         points = await get_join_points(message.chat.id)
 
@@ -1139,11 +2867,11 @@ async def reset_points_all_cmd(message: types.Message):
         return
 
     token = secrets.token_urlsafe(8).replace("-", "").replace("_", "")
-    pending_resets[token] = {
+    await pending_resets.put(token, {
         "created": time.time(),
         "chat_id": message.chat.id,
         "initiator_id": message.from_user.id
-    }
+    })
 
     jp = await get_join_points(message.chat.id)
 
@@ -1154,68 +2882,155 @@ async def reset_points_all_cmd(message: types.Message):
     await send_rich(message, b, reply_markup=reset_confirm_kb(token))
 
 
+async def reset_chat_points(
+    chat_id: int,
+    join_points: int,
+    progress_message: types.Message | None = None,
+    actor_id: int | None = None
+) -> int:
+    """
+    Сброс баллов чата пачками по RESET_CHUNK_SIZE в порядке user_id.
+    Каждая пачка — отдельный короткий оператор, между пачками отдаём управление,
+    чтобы переводы и /балл не ждали блокировок всего чата. Строки, где баллы
+    уже равны стартовым, не трогаем. Возвращает число изменённых строк.
+    """
+    total = await count_chat_users(chat_id)
+    last_id = -(2 ** 63)
+    scanned = 0
+    changed = 0
+    last_progress = time.monotonic()
+
+    while True:
+        # пачка и её записи в журнале — одна транзакция
+        async with db_conn() as conn, conn.transaction():
+            row = await conn.fetchrow("""
+                WITH batch AS (
+                    -- FOR UPDATE: points здесь — последняя закоммиченная версия строки под нашей блокировкой,
+                    -- т.е. ровно то значение, которое UPDATE ниже перезапишет (старый баланс для журнала)
+                    SELECT user_id, points FROM users
+                    WHERE chat_id = $1 AND user_id > $2
+                    ORDER BY user_id
+                    LIMIT $3
+                    FOR UPDATE
+                ),
+                upd AS (
+                    UPDATE users u
+                    SET points = $4
+                    FROM batch b
+                    WHERE u.chat_id = $1 AND u.user_id = b.user_id
+                      AND u.points IS DISTINCT FROM $4
+                    RETURNING u.user_id, b.points AS old_points
+                )
+                SELECT
+                    (SELECT MAX(user_id) FROM batch) AS last_id,
+                    (SELECT COUNT(*) FROM batch) AS scanned,
+                    (SELECT COUNT(*) FROM upd) AS changed,
+                    (SELECT array_agg(user_id ORDER BY user_id) FROM upd) AS changed_ids,
+                    (SELECT array_agg(old_points ORDER BY user_id) FROM upd) AS old_points
+            """, chat_id, last_id, RESET_CHUNK_SIZE, join_points)
+            changed_rows = list(zip(row["changed_ids"] or [], row["old_points"] or []))
+            await copy_ledger(conn, [
+                (chat_id, uid, actor_id, join_points - (old_pts or 0), join_points, "reset", None)
+                for uid, old_pts in changed_rows
+            ])
+
+        if not row["scanned"]:
+            break
+        last_id = int(row["last_id"])
+        scanned += int(row["scanned"])
+        changed += int(row["changed"])
+        # память правим по строкам именно этой пачки: изменения, сделанные после неё, не затираем
+        for uid, old_pts in changed_rows:
+            on_points_changed(chat_id, uid, old_pts or 0, join_points)
+        metric_inc("reset_chunks")
+
+        if int(row["scanned"]) < RESET_CHUNK_SIZE:
+            break
+
+        if progress_message is not None and time.monotonic() - last_progress >= RESET_PROGRESS_INTERVAL:
+            last_progress = time.monotonic()
+            post(progress_message.edit_text(f"⏳ Сброс баллов… {scanned} из ~{max(total, scanned)}"))
+
+        await asyncio.sleep(RESET_CHUNK_PAUSE)
+
+    return changed
+
+
+_reset_tasks: Dict[int, asyncio.Task] = {}
+
+
+async def run_chat_reset(chat_id: int, actor_id: int, message: types.Message):
+    """
+    Фоновая задача сброса: идёт вне очереди апдейтов чата, так что чат всё это время живёт.
+    """
+    try:
+        await ensure_chat_settings(chat_id)
+        invalidate_chat_settings(chat_id)
+        jp = await get_join_points(chat_id)
+
+        changed = await reset_chat_points(chat_id, jp, progress_message=message, actor_id=actor_id)
+
+        b = RichText()
+        b.add("✅ ").bold("Готово").add("\n")
+        b.add("Баллы всех участников выставлены в стартовое значение | ").bold(jp).add("\n")
+        b.add("Изменено | ").bold(changed)
+        await send_rich(message, b, edit=True)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logging.warning(f"Reset of chat {chat_id} failed: {e}")
+        post(message.edit_text("❌ Сброс прерван из-за ошибки. Повтори команду."))
+    finally:
+        _reset_tasks.pop(chat_id, None)
+
+
 @dp.callback_query(F.data.startswith("rconf:"))
 async def reset_points_confirm(callback: types.CallbackQuery):
     token = callback.data.split(":", 1)[1]
-    req = pending_resets.get(token)
+    req = await pending_resets.get(token)
     if not req:
-        return await callback.answer()
+        return callback.answer()
 
     if callback.from_user.id != req["initiator_id"]:
-        return await callback.answer()
+        return callback.answer()
 
     if time.time() - req["created"] > RESET_CONFIRM_TTL:
-        pending_resets.pop(token, None)
-        try:
-            await callback.message.edit_text("⌛ Подтверждение истекло.")
-        except Exception:
-            pass
-        return await callback.answer()
+        await pending_resets.pop(token)
+        post(callback.message.edit_text("⌛ Подтверждение истекло."))
+        return callback.answer()
 
     chat_id = int(req["chat_id"])
 
     if not await has_level(callback.from_user.id, chat_id, 2):
-        return await callback.answer()
+        return callback.answer()
 
-    await ensure_chat_settings(chat_id)
+    if chat_id in _reset_tasks:
+        return callback.answer("⏳ Сброс в этом чате уже идёт", show_alert=True)
 
-    async with pool.acquire() as conn:
-        await conn.execute(
-            """
-            UPDATE users
-            SET points = (SELECT join_points FROM chat_settings WHERE chat_id = $1)
-            WHERE chat_id = $1
-            """,
-            chat_id
-        )
-
-    pending_resets.pop(token, None)
+    if await pending_resets.pop(token) is None:
+        return callback.answer()
 
-    jp = await get_join_points(chat_id)
-    b = RichText()
-    b.add("✅ ").bold("Готово").add("\n")
-    b.add("Баллы всех участников выставлены в стартовое значение | ").bold(jp)
-    await send_rich(callback.message, b, edit=True)
-    return await callback.answer()
+    # сброс может идти долго — запускаем в фоне, кнопку и очередь чата отпускаем сразу
+    _reset_tasks[chat_id] = asyncio.create_task(
+        run_chat_reset(chat_id, callback.from_user.id, callback.message)
+    )
+    return callback.answer("⏳ Сброс запущен")
 
 
 @dp.callback_query(F.data.startswith("rcancel:"))
 async def reset_points_cancel(callback: types.CallbackQuery):
     token = callback.data.split(":", 1)[1]
-    req = pending_resets.get(token)
+    req = await pending_resets.get(token)
     if not req:
-        return await callback.answer()
+        return callback.answer()
 
     # не даём другим пользователям трогать чужие кнопки
     if callback.from_user.id != req["initiator_id"]:
-        return await callback.answer()
+        return callback.answer()
 
-    pending_resets.pop(token, None)
-    try:
-        await callback.message.edit_text("❌ Отменено.")
-    except Exception:
-        pass
-    return await callback.answer()
+    await pending_resets.pop(token)
+    post(callback.message.edit_text("❌ Отменено."))
+    return callback.answer()
 
 @dp.message(Command("топб", "topb"))
 async def show_top_command(message: types.Message):
@@ -1236,12 +3051,13 @@ async def process_top_pagination(callback: types.CallbackQuery):
     data = callback.data.split(":")
     owner_id = int(data[1])
     page = int(data[2])
+    cursor = (data[3], int(data[4]), int(data[5])) if len(data) >= 6 else None
 
     if callback.from_user.id != owner_id:
-        return await callback.answer()
+        return callback.answer()
 
-    await send_top_page(callback.message, page, owner_id=owner_id, edit=True)
-    await callback.answer()
+    await send_top_page(callback.message, page, owner_id=owner_id, edit=True, cursor=cursor)
+    return callback.answer()
 
 
 @dp.message(Command("передатьб", "payb"))
@@ -1255,74 +3071,68 @@ async def transfer_points(message: types.Message):
 
     args = message.text.split()
     if len(args) < 2:
-        return await message.reply("Используй: /передатьб 30 @username или ответом: /передатьб 30")
+        return post(message.reply("Используй: /передатьб 30 @username или ответом: /передатьб 30"))
 
     try:
         amount = int(args[1])
     except ValueError:
-        return await message.reply("Ошибка! Используй: /передатьб 30 @username")
+        return post(message.reply("Ошибка! Используй: /передатьб 30 @username"))
 
     if amount <= 0:
-        return await message.reply("Введите положительное число.")
+        return post(message.reply("Введите положительное число."))
 
     tid, tname, tuname, err = await resolve_target(message, args)
     if err == "no_target":
-        return await message.reply("⚠️ Укажи @username или ответь на сообщение.")
+        return post(message.reply("⚠️ Укажи @username или ответь на сообщение."))
     if err == "not_found":
-        return await message.reply("❌ Пользователь не найден. Пусть он напишет сообщение в любой чат с ботом.")
+        return post(message.reply("❌ Пользователь не найден. Пусть он напишет сообщение в любой чат с ботом."))
     if err == "not_in_chat":
-        return await message.reply("❌ Этот @username не найден среди участников этого чата.")
+        return post(message.reply("❌ Этот @username не найден среди участников этого чата."))
 
     if not await user_exists_in_chat(tid, message.chat.id):
-        return await message.reply("❌ Пользователь не найден в базе этого чата.\nПусть он напишет сообщение.")
+        return post(message.reply("❌ Пользователь не найден в базе этого чата.\nПусть он напишет сообщение."))
 
     if tid == message.from_user.id:
-        return await message.reply("Нельзя переводить баллы самому себе.")
+        return post(message.reply("Нельзя переводить баллы самому себе."))
 
     received_raw = amount // TRANSFER_RATE
     if received_raw <= 0:
-        return await message.reply(f"Минимальный перевод | {TRANSFER_RATE} (получит 1 балл).")
-
-    async with pool.acquire() as conn:
-        sender_pts = await conn.fetchval(
-            "SELECT points FROM users WHERE user_id = $1 AND chat_id = $2",
-            message.from_user.id, message.chat.id
-        )
-        if sender_pts is None:
-            sender_pts = await get_join_points(message.chat.id)
+        return post(message.reply(f"Минимальный перевод | {TRANSFER_RATE} (получит 1 балл)."))
 
-        target_pts = await conn.fetchval(
-            "SELECT points FROM users WHERE user_id = $1 AND chat_id = $2",
-            tid, message.chat.id
-        )
-        if target_pts is None:
-            target_pts = await get_join_points(message.chat.id)
+    join_points = await get_join_points(message.chat.id)
+    async with db_conn() as conn:
+        sender_pts = await fetch_points(conn, message.from_user.id, message.chat.id)
+        target_pts = await fetch_points(conn, tid, message.chat.id)
+    if sender_pts is None:
+        sender_pts = join_points
+    if target_pts is None:
+        target_pts = join_points
 
     if target_pts + received_raw > BALANCE_MAX:
         can = max(0, BALANCE_MAX - target_pts)
-        return await message.reply(
+        return post(message.reply(
             f"❌ Перевод невозможен: будет больше {BALANCE_MAX}.\n"
             f"Сейчас: {target_pts}\n"
             f"Максимум принять: {can}\n"
             f"Ты хотел (получит): {received_raw}"
-        )
+        ))
 
     actual_received = received_raw
     actual_spent = actual_received * TRANSFER_RATE
 
     if sender_pts - actual_spent < MIN_POINTS_TO_TRANSFER:
-        return await message.reply(
+        return post(message.reply(
             f"❌ После перевода должно остаться минимум {MIN_POINTS_TO_TRANSFER}.\n"
             f"Сейчас: {sender_pts}\n"
             f"Спишется: {actual_spent}\n"
             f"Останется: {sender_pts - actual_spent}"
-        )
+        ))
 
     if sender_pts < actual_spent:
-        return await message.reply("❌ Недостаточно баллов для перевода.")
+        return post(message.reply("❌ Недостаточно баллов для перевода."))
 
     token = secrets.token_urlsafe(8).replace("-", "").replace("_", "")
-    pending_transfers[token] = {
+    await pending_transfers.put(token, {
         "created": time.time(),
         "chat_id": message.chat.id,
         "sender_id": message.from_user.id,
@@ -1331,7 +3141,7 @@ async def transfer_points(message: types.Message):
         "target_name": tname,
         "spent": actual_spent,
         "received": actual_received
-    }
+    })
 
     b = RichText()
     b.add("💠 ").bold("Подтверждение перевода").add("\n\n")
@@ -1347,65 +3157,83 @@ async def transfer_points(message: types.Message):
 @dp.callback_query(F.data.startswith("tconf:"))
 async def transfer_confirm(callback: types.CallbackQuery):
     token = callback.data.split(":", 1)[1]
-    req = pending_transfers.get(token)
+    req = await pending_transfers.get(token)
 
     if not req:
-        return await callback.answer("Заявка не найдена или уже обработана.", show_alert=True)
+        return callback.answer("Заявка не найдена или уже обработана.", show_alert=True)
 
     if time.time() - req["created"] > TRANSFER_CONFIRM_TTL:
-        pending_transfers.pop(token, None)
-        await callback.message.edit_text("⌛ Заявка на перевод истекла.")
-        return await callback.answer()
+        await pending_transfers.pop(token)
+        post(callback.message.edit_text("⌛ Заявка на перевод истекла."))
+        return callback.answer()
 
     if callback.from_user.id != req["sender_id"]:
-        return await callback.answer()
-
-    async with pool.acquire() as conn:
-        sender_pts = await conn.fetchval(
-            "SELECT points FROM users WHERE user_id = $1 AND chat_id = $2",
-            req["sender_id"], req["chat_id"]
-        )
-        if sender_pts is None:
-            sender_pts = await get_join_points(req["chat_id"])
-
-        target_pts = await conn.fetchval(
-            "SELECT points FROM users WHERE user_id = $1 AND chat_id = $2",
-            req["target_id"], req["chat_id"]
+        return callback.answer()
+
+    # забираем заявку сразу: двойное нажатие не проведёт перевод дважды
+    if await pending_transfers.pop(token) is None:
+        return callback.answer("Заявка не найдена или уже обработана.", show_alert=True)
+
+    actual_received = req["received"]
+    actual_spent = req["spent"]
+    join_points = await get_join_points(req["chat_id"])
+
+    # один оператор = одна транзакция: строки блокируются в порядке user_id,
+    # лимиты проверяются в том же UPDATE, гонок с /балл и параллельными подтверждениями нет
+    async with db_conn() as conn:
+        row = await conn.fetchrow("""
+            WITH locked AS (
+                SELECT user_id, points FROM users
+                WHERE chat_id = $1 AND user_id IN ($2, $3)
+                ORDER BY user_id
+                FOR UPDATE
+            ),
+            bal AS (
+                SELECT
+                    COALESCE((SELECT points FROM locked WHERE user_id = $2), $6) AS sender_pts,
+                    COALESCE((SELECT points FROM locked WHERE user_id = $3), $6) AS target_pts
+            ),
+            upd AS (
+                UPDATE users u
+                SET points = CASE WHEN u.user_id = $2 THEN bal.sender_pts - $4 ELSE bal.target_pts + $5 END
+                FROM bal
+                WHERE u.chat_id = $1 AND u.user_id IN ($2, $3)
+                  AND bal.target_pts + $5 <= $7
+                  AND bal.sender_pts >= $4
+                  AND bal.sender_pts - $4 >= $8
+                RETURNING u.user_id, u.points
+            ),
+            led AS (
+                INSERT INTO points_ledger (chat_id, user_id, actor_id, delta, balance, kind)
+                SELECT
+                    $1, upd.user_id, $2,
+                    CASE WHEN upd.user_id = $2 THEN -$4 ELSE $5 END,
+                    upd.points,
+                    CASE WHEN upd.user_id = $2 THEN 'transfer_out' ELSE 'transfer_in' END
+                FROM upd
+            )
+            SELECT bal.sender_pts, bal.target_pts, (SELECT COUNT(*) FROM upd) AS updated
+            FROM bal
+        """,
+            req["chat_id"], req["sender_id"], req["target_id"],
+            actual_spent, actual_received, join_points,
+            BALANCE_MAX, MIN_POINTS_TO_TRANSFER
         )
-        if target_pts is None:
-            target_pts = await get_join_points(req["chat_id"])
 
-        actual_received = req["received"]
-        actual_spent = req["spent"]
+    sender_pts = int(row["sender_pts"])
+    target_pts = int(row["target_pts"])
 
+    if not row["updated"]:
         if target_pts + actual_received > BALANCE_MAX:
-            pending_transfers.pop(token, None)
-            await callback.message.edit_text(f"❌ Перевод невозможен: больше {BALANCE_MAX}.")
-            return await callback.answer()
-
-        if sender_pts < actual_spent:
-            pending_transfers.pop(token, None)
-            await callback.message.edit_text("❌ Перевод невозможен: недостаточно баллов у отправителя.")
-            return await callback.answer()
-
-        if sender_pts - actual_spent < MIN_POINTS_TO_TRANSFER:
-            pending_transfers.pop(token, None)
-            await callback.message.edit_text(f"❌ Перевод невозможен: после перевода минимум {MIN_POINTS_TO_TRANSFER}.")
-            return await callback.answer()
-
-        new_sender = sender_pts - actual_spent
-        new_target = target_pts + actual_received
-
-        await conn.execute(
-            "UPDATE users SET points = $1 WHERE user_id = $2 AND chat_id = $3",
-            new_sender, req["sender_id"], req["chat_id"]
-        )
-        await conn.execute(
-            "UPDATE users SET points = $1 WHERE user_id = $2 AND chat_id = $3",
-            new_target, req["target_id"], req["chat_id"]
-        )
+            post(callback.message.edit_text(f"❌ Перевод невозможен: больше {BALANCE_MAX}."))
+        elif sender_pts < actual_spent:
+            post(callback.message.edit_text("❌ Перевод невозможен: недостаточно баллов у отправителя."))
+        else:
+            post(callback.message.edit_text(f"❌ Перевод невозможен: после перевода минимум {MIN_POINTS_TO_TRANSFER}."))
+        return callback.answer()
 
-    pending_transfers.pop(token, None)
+    on_points_changed(req["chat_id"], req["sender_id"], sender_pts, sender_pts - actual_spent)
+    on_points_changed(req["chat_id"], req["target_id"], target_pts, target_pts + actual_received)
 
     b = RichText()
     b.add("✅ ").bold("Перевод выполнен!").add("\n")
@@ -1415,23 +3243,23 @@ async def transfer_confirm(callback: types.CallbackQuery):
     b.add("📉 Списано | ").bold(actual_spent).add(f" (курс {TRANSFER_RATE}:1)")
 
     await send_rich(callback.message, b, edit=True)
-    await callback.answer()
+    return callback.answer()
 
 
 @dp.callback_query(F.data.startswith("tcancel:"))
 async def transfer_cancel(callback: types.CallbackQuery):
     token = callback.data.split(":", 1)[1]
-    req = pending_transfers.get(token)
+    req = await pending_transfers.get(token)
 
     if not req:
-        return await callback.answer("Заявка не найдена или уже обработана.", show_alert=True)
+        return callback.answer("Заявка не найдена или уже обработана.", show_alert=True)
 
     if callback.from_user.id != req["sender_id"]:
-        return await callback.answer()
+        return callback.answer()
 
-    pending_transfers.pop(token, None)
-    await callback.message.edit_text("❌ Перевод отменён.")
-    await callback.answer()
+    await pending_transfers.pop(token)
+    post(callback.message.edit_text("❌ Перевод отменён."))
+    return callback.answer()
 
 
 @dp.message(Command("балл", "ball"))
@@ -1441,51 +3269,69 @@ async def change_points(message: types.Message):
 
     args = message.text.split()
     if len(args) < 2:
-        return await message.reply("Используй: /балл +10 @username причина (или ответом: /балл +10 причина)")
+        return post(message.reply("Используй: /балл +10 @username причина (или ответом: /балл +10 причина)"))
 
     try:
         amount = int(args[1])
     except ValueError:
-        return await message.reply("Ошибка! Пример: /балл -2 @user флуд")
+        return post(message.reply("Ошибка! Пример: /балл -2 @user флуд"))
 
     tid, tname, tuname, err = await resolve_target(message, args)
     if err == "no_target":
-        return await message.reply("⚠️ Укажи @username или ответь на сообщение.")
+        return post(message.reply("⚠️ Укажи @username или ответь на сообщение."))
     if err == "not_found":
-        return await message.reply("❌ Пользователь не найден. Пусть он напишет сообщение в любой чат с ботом.")
+        return post(message.reply("❌ Пользователь не найден. Пусть он напишет сообщение в любой чат с ботом."))
     if err == "not_in_chat":
-        return await message.reply("❌ Этот @username не найден среди участников этого чата.")
+        return post(message.reply("❌ Этот @username не найден среди участников этого чата."))
 
     if not await user_exists_in_chat(tid, message.chat.id):
-        return await message.reply("❌ Пользователь не найден в базе этого чата.\nПусть он напишет сообщение.")
+        return post(message.reply("❌ Пользователь не найден в базе этого чата.\nПусть он напишет сообщение."))
 
     reason = extract_reason_from_args(args)
 
-    async with pool.acquire() as conn:
-        current_pts = await conn.fetchval(
-            "SELECT points FROM users WHERE user_id = $1 AND chat_id = $2",
-            tid, message.chat.id
-        )
-        if current_pts is None:
-            current_pts = await get_join_points(message.chat.id)
+    join_points = await get_join_points(message.chat.id)
+    new_pts = None
+    async with db_conn() as conn:
+        # относительное изменение с проверкой лимитов в том же UPDATE: параллельный перевод
+        # или другой /балл между чтением и записью не затрётся
+        if abs(amount) <= BALANCE_MAX - BALANCE_MIN:
+            new_pts = await conn.fetchval("""
+                WITH upd AS (
+                    UPDATE users
+                    SET points = COALESCE(points, $3) + $4
+                    WHERE user_id = $1 AND chat_id = $2
+                      AND ($4 <= 0 OR COALESCE(points, $3) + $4 <= $6)
+                      AND ($4 >= 0 OR COALESCE(points, $3) + $4 >= $5)
+                    RETURNING points
+                ),
+                led AS (
+                    INSERT INTO points_ledger (chat_id, user_id, actor_id, delta, balance, kind, reason)
+                    SELECT $2, $1, $7, $4, points, 'admin', $8 FROM upd
+                )
+                SELECT points FROM upd
+            """,
+                tid, message.chat.id, join_points, amount, BALANCE_MIN, BALANCE_MAX,
+                message.from_user.id, reason or None
+            )
+        if new_pts is None:
+            current_pts = await fetch_points(conn, tid, message.chat.id)
 
-        if amount > 0 and current_pts + amount > BALANCE_MAX:
-            return await message.reply(
+    # отвечаем уже отпустив соединение
+    if new_pts is None:
+        if current_pts is None:
+            return post(message.reply("❌ Пользователь не найден в базе этого чата.\nПусть он напишет сообщение."))
+        if amount > 0:
+            return post(message.reply(
                 f"❌ Нельзя начислить столько: будет превышен лимит {BALANCE_MAX}.\n"
                 f"Сейчас: {current_pts}, начисляешь: {amount}, было бы: {current_pts + amount}."
-            )
-
-        if amount < 0 and current_pts + amount < BALANCE_MIN:
-            return await message.reply(
-                f"❌ Нельзя снять столько: баланс не может быть меньше {BALANCE_MIN}.\n"
-                f"Сейчас: {current_pts}, снимаешь: {abs(amount)}, было бы: {current_pts + amount}."
-            )
+            ))
+        return post(message.reply(
+            f"❌ Нельзя снять столько: баланс не может быть меньше {BALANCE_MIN}.\n"
+            f"Сейчас: {current_pts}, снимаешь: {abs(amount)}, было бы: {current_pts + amount}."
+        ))
 
-        new_pts = current_pts + amount
-        await conn.execute(
-            "UPDATE users SET points = $1 WHERE user_id = $2 AND chat_id = $3",
-            new_pts, tid, message.chat.id
-        )
+    current_pts = new_pts - amount
+    on_points_changed(message.chat.id, tid, current_pts, new_pts)
 
     b = RichText()
     if amount >= 0:
@@ -1506,7 +3352,7 @@ async def change_points(message: types.Message):
     action = "начислил" if amount >= 0 else "снял"
     sign = "+" if amount >= 0 else "-"
 
-    await log_to_owner(
+    log_to_owner(
         "🧾 Лог баллов\n"
         f"🏷 Чат: {chat_title} ({message.chat.id})\n"
         f"👮 Админ: {message.from_user.first_name} ({message.from_user.id})\n"
@@ -1524,58 +3370,101 @@ async def change_points_mass(message: types.Message):
 
     args = message.text.split()
     if len(args) < 4:
-        return await message.reply("Используй: /баллм -5 @user1 @user2 причина (можно много @username)")
+        return post(message.reply("Используй: /баллм -5 @user1 @user2 причина (можно много @username)"))
 
     try:
         amount = int(args[1])
     except ValueError:
-        return await message.reply("Ошибка! Пример: /баллм -5 @user1 @user2 флуд")
+        return post(message.reply("Ошибка! Пример: /баллм -5 @user1 @user2 флуд"))
 
     mentions = [a for a in args[2:] if a.startswith("@")]
     if not mentions:
-        return await message.reply("⚠️ Укажи хотя бы один @username.")
+        return post(message.reply("⚠️ Укажи хотя бы один @username."))
 
     reason = extract_mass_reason(args)
 
     ok_lines = []
     fail_lines = []
 
-    async with pool.acquire() as conn:
-        for raw in mentions:
-            uname = raw.replace("@", "").lower()
+    unames = []
+    for raw in mentions:
+        uname = raw.replace("@", "").lower()
+        if uname not in unames:
+            unames.append(uname)
+
+    join_points = await get_join_points(message.chat.id)
 
-            row = await conn.fetchrow(
-                "SELECT user_id, name, points, username FROM users WHERE chat_id = $1 AND username = $2",
-                message.chat.id, uname
+    # за пределами диапазона баланса не пройдёт ни одно изменение; в SQL отдаём заведомо
+    # непроходящее значение в пределах int4, отчёт по каждому строим с настоящим amount
+    span = BALANCE_MAX - BALANCE_MIN
+    sql_amount = amount if abs(amount) <= span else (span + 1 if amount > 0 else -(span + 1))
+
+    # вся пачка одним оператором: поиск по username, проверка лимитов и UPDATE;
+    # строки блокируются в порядке user_id — пересекающиеся /ballm не дедлочат друг друга;
+    # отчёт по каждому — из возвращённых строк, журнал — COPY в той же транзакции
+    async with db_conn() as conn, conn.transaction():
+        rows = await conn.fetch("""
+            WITH req AS (
+                SELECT uname, ord FROM unnest($2::text[]) WITH ORDINALITY AS r(uname, ord)
+            ),
+            targets AS (
+                SELECT DISTINCT ON (r.uname)
+                    r.uname, u.user_id, u.name
+                FROM req r
+                JOIN users u ON u.chat_id = $1 AND u.username = r.uname
+                ORDER BY r.uname, u.join_seq DESC
+            ),
+            locked AS (
+                SELECT u.user_id, COALESCE(u.points, $4) AS points
+                FROM users u
+                WHERE u.chat_id = $1 AND u.user_id IN (SELECT user_id FROM targets)
+                ORDER BY u.user_id
+                FOR UPDATE
+            ),
+            upd AS (
+                UPDATE users u
+                SET points = l.points + $3
+                FROM locked l
+                WHERE u.chat_id = $1 AND u.user_id = l.user_id
+                  AND ($3 <= 0 OR l.points + $3 <= $6)
+                  AND ($3 >= 0 OR l.points + $3 >= $5)
+                RETURNING u.user_id, u.points
             )
-            if not row:
-                fail_lines.append(f"• @{uname}: не найден в этом чате")
-                continue
+            SELECT r.uname, t.user_id, t.name, l.points AS old_points, upd.points AS new_points
+            FROM req r
+            LEFT JOIN targets t ON t.uname = r.uname
+            LEFT JOIN locked l ON l.user_id = t.user_id
+            LEFT JOIN upd ON upd.user_id = t.user_id
+            ORDER BY r.ord
+        """, message.chat.id, unames, sql_amount, join_points, BALANCE_MIN, BALANCE_MAX)
+        await copy_ledger(conn, [
+            (message.chat.id, r["user_id"], message.from_user.id, amount, r["new_points"], "mass", reason or None)
+            for r in rows if r["new_points"] is not None
+        ])
 
-            tid = int(row["user_id"])
-            tname = row["name"] or uname
-            current_pts = row["points"]
-            if current_pts is None:
-                current_pts = await get_join_points(message.chat.id)
+    for r in rows:
+        uname = r["uname"]
+        if r["user_id"] is None:
+            fail_lines.append(f"• @{uname}: не найден в этом чате")
+            continue
 
-            if amount > 0 and current_pts + amount > BALANCE_MAX:
-                fail_lines.append(f"• {tname}: нельзя +{amount} (сейчас {current_pts}, было бы > {BALANCE_MAX})")
-                continue
+        tid = int(r["user_id"])
+        tname = r["name"] or uname
+        current_pts = int(r["old_points"])
 
-            if amount < 0 and current_pts + amount < BALANCE_MIN:
+        if r["new_points"] is None:
+            if amount > 0:
+                fail_lines.append(f"• {tname}: нельзя +{amount} (сейчас {current_pts}, было бы > {BALANCE_MAX})")
+            else:
                 fail_lines.append(f"• {tname}: нельзя {amount} (сейчас {current_pts}, было бы < {BALANCE_MIN})")
-                continue
-
-            new_pts = current_pts + amount
-            await conn.execute(
-                "UPDATE users SET points = $1 WHERE user_id = $2 AND chat_id = $3",
-                new_pts, tid, message.chat.id
-            )
+            continue
 
-            ok_lines.append((tname, tid, current_pts, new_pts))
+        new_pts = int(r["new_points"])
+        on_points_changed(message.chat.id, tid, new_pts - amount, new_pts)
+        ok_lines.append((tname, tid, new_pts - amount, new_pts))
 
     if not ok_lines and fail_lines:
-        return await message.answer("❌ Никому не удалось изменить баллы.\n\n" + "\n".join(fail_lines))
+        return post(message.answer("❌ Никому не удалось изменить баллы.\n\n" + "\n".join(fail_lines)))
 
     sign = "+" if amount >= 0 else "-"
     action_word = "начислил" if amount >= 0 else "снял"
@@ -1615,17 +3504,17 @@ async def promote_owner(message: types.Message):
 
     tid, name, tuname, err = await resolve_target(message, args)
     if err == "no_target":
-        return await message.reply("⚠️ Укажи @username или ответь на сообщение.\nПример: /повысить @user 2")
+        return post(message.reply("⚠️ Укажи @username или ответь на сообщение.\nПример: /повысить @user 2"))
     if err == "not_found":
-        return await message.reply("❌ Пользователь не найден. Пусть он напишет сообщение в любой чат с ботом.")
+        return post(message.reply("❌ Пользователь не найден. Пусть он напишет сообщение в любой чат с ботом."))
     if err == "not_in_chat":
-        return await message.reply("❌ Этот @username не найден среди участников этого чата.")
+        return post(message.reply("❌ Этот @username не найден среди участников этого чата."))
 
     if tid == OWNER_ID:
-        return await message.reply("❌ Нельзя менять права владельца.")
+        return post(message.reply("❌ Нельзя менять права владельца."))
 
     if not await user_exists_in_chat(tid, message.chat.id):
-        return await message.reply("❌ Пользователь не найден в базе этого чата.\nПусть он напишет сообщение.")
+        return post(message.reply("❌ Пользователь не найден в базе этого чата.\nПусть он напишет сообщение."))
 
     await set_admin_level(message.chat.id, tid, level, mode="force")
 
@@ -1644,17 +3533,17 @@ async def make_admin_lvl1(message: types.Message):
     args = message.text.split()
     tid, name, tuname, err = await resolve_target(message, args)
     if err == "no_target":
-        return await message.reply("⚠️ Укажи @username или ответь.\nПример: /админ @user")
+        return post(message.reply("⚠️ Укажи @username или ответь.\nПример: /админ @user"))
     if err == "not_found":
-        return await message.reply("❌ Пользователь не найден. Пусть он напишет сообщение в любой чат с ботом.")
+        return post(message.reply("❌ Пользователь не найден. Пусть он напишет сообщение в любой чат с ботом."))
     if err == "not_in_chat":
-        return await message.reply("❌ Этот @username не найден среди участников этого чата.")
+        return post(message.reply("❌ Этот @username не найден среди участников этого чата."))
 
     if tid == OWNER_ID:
-        return await message.reply("❌ Нельзя менять права владельца.")
+        return post(message.reply("❌ Нельзя менять права владельца."))
 
     if not await user_exists_in_chat(tid, message.chat.id):
-        return await message.reply("❌ Пользователь не найден в базе этого чата.\nПусть он напишет сообщение.")
+        return post(message.reply("❌ Пользователь не найден в базе этого чата.\nПусть он напишет сообщение."))
 
     current = await get_admin_level(tid, message.chat.id)
     if current >= 2:
@@ -1677,24 +3566,24 @@ async def remove_admin(message: types.Message):
     args = message.text.split()
     tid, name, tuname, err = await resolve_target(message, args)
     if err == "no_target":
-        return await message.reply("⚠️ Укажи @username или ответь.\nПример: /разжаловать @user")
+        return post(message.reply("⚠️ Укажи @username или ответь.\nПример: /разжаловать @user"))
     if err == "not_found":
-        return await message.reply("❌ Пользователь не найден. Пусть он напишет сообщение в любой чат с ботом.")
+        return post(message.reply("❌ Пользователь не найден. Пусть он напишет сообщение в любой чат с ботом."))
     if err == "not_in_chat":
-        return await message.reply("❌ Этот @username не найден среди участников этого чата.")
+        return post(message.reply("❌ Этот @username не найден среди участников этого чата."))
 
     if tid == OWNER_ID:
-        return await message.reply("❌ Нельзя разжаловать владельца.")
+        return post(message.reply("❌ Нельзя разжаловать владельца."))
 
     if not await user_exists_in_chat(tid, message.chat.id):
-        return await message.reply("❌ Пользователь не найден в базе этого чата.")
+        return post(message.reply("❌ Пользователь не найден в базе этого чата."))
 
     current = await get_admin_level(tid, message.chat.id)
     if current <= 0:
-        return await message.answer("ℹ️ Этот пользователь не админ.", disable_web_page_preview=True)
+        return post(message.answer("ℹ️ Этот пользователь не админ.", disable_web_page_preview=True))
 
     if not issuer_is_owner and current >= 2:
-        return await message.reply("❌ Ты можешь снимать только админа 1 уровня.")
+        return post(message.reply("❌ Ты можешь снимать только админа 1 уровня."))
 
     await remove_admin_level(message.chat.id, tid)
     b = RichText().add("❌ ").link(name, f"tg://user?id={tid}").add(" больше ").bold("не админ").add(".")
@@ -1706,7 +3595,7 @@ async def list_admins(message: types.Message):
     if message.from_user.id != OWNER_ID and not await has_level(message.from_user.id, message.chat.id, 2):
         return
 
-    async with pool.acquire() as conn:
+    async with db_conn() as conn:
         rows = await conn.fetch("""
             SELECT 
                 a.user_id,
@@ -1722,7 +3611,7 @@ async def list_admins(message: types.Message):
         """, message.chat.id)
 
     if not rows:
-        return await message.answer("Список админов пуст.", disable_web_page_preview=True)
+        return post(message.answer("Список админов пуст.", disable_web_page_preview=True))
 
     b = RichText()
     b.add("🛡 ").bold("Список админов").add("\n\n")
@@ -1741,6 +3630,23 @@ async def list_admins(message: types.Message):
     await send_rich(message, b)
 
 
+@dp.message(Command("метрики", "bmetrics"))
+async def show_metrics(message: types.Message):
+    if message.from_user.id != OWNER_ID:
+        return
+
+    b = RichText()
+    b.add("📈 ").bold("Метрики бота").add("\n\n")
+    if not METRICS:
+        b.add("— пусто —")
+    for name in sorted(METRICS):
+        value = METRICS[name]
+        if float(value).is_integer():
+            value = int(value)
+        b.add(f"• {name} | ").code(str(value)).add("\n")
+    await send_rich(message, b)
+
+
 @dp.message(F.entities)
 async def catch_custom_emoji_id_private_only(message: types.Message):
     if message.chat.type != "private":
@@ -1755,13 +3661,29 @@ async def catch_custom_emoji_id_private_only(message: types.Message):
             ids.append(ent.custom_emoji_id)
 
     if ids:
-        await message.answer("custom_emoji_id:\n" + "\n".join(ids), parse_mode=None)
+        post(message.answer("custom_emoji_id:\n" + "\n".join(ids), parse_mode=None))
+
+
+@dp.chat_member()
+async def on_chat_member(event: types.ChatMemberUpdated):
+    status = event.new_chat_member.status
+    set_membership(event.chat.id, event.new_chat_member.user.id, status not in ("left", "kicked"))
+
+
+@dp.message(F.new_chat_members | F.left_chat_member)
+async def on_members_message(message: types.Message):
+    for u in message.new_chat_members or []:
+        set_membership(message.chat.id, u.id, True)
+    if message.left_chat_member:
+        set_membership(message.chat.id, message.left_chat_member.id, False)
+    # служебное сообщение до auto_update не дойдёт — обновляем автора здесь
+    await auto_update(message)
 
 
 @dp.message()
 async def auto_update(message: types.Message):
     if message.from_user and message.chat.type in ["group", "supergroup"]:
-        await update_user_data(
+        queue_user_data(
             message.from_user.id,
             message.chat.id,
             message.from_user.first_name,
@@ -1769,10 +3691,129 @@ async def auto_update(message: types.Message):
         )
 
 
+@dp.shutdown()
+async def on_shutdown():
+    if _member_flush_task:
+        _member_flush_task.cancel()
+        with suppress(asyncio.CancelledError):
+            await _member_flush_task
+    if _pending_sweep_task:
+        _pending_sweep_task.cancel()
+    for task in list(_reset_tasks.values()):
+        task.cancel()
+        with suppress(asyncio.CancelledError):
+            await task
+    if _audit_task:
+        _audit_task.cancel()
+        with suppress(asyncio.CancelledError):
+            await _audit_task
+    await flush_member_buffer()
+    await flush_audit_log()
+    # всё, что хэндлеры поставили в очереди отправки, уходит до закрытия сессии
+    await outbound.drain(SEND_DRAIN_TIMEOUT)
+    await stop_invalidation_listener()
+
+
+class WebhookRequestHandler(SimpleRequestHandler):
+    """
+    Webhook-обработчик: проверяет X-Telegram-Bot-Api-Secret-Token и обрабатывает апдейт прямо в запросе —
+    если хэндлер вернул метод (return callback.answer()), он уходит телеграму в теле ответа,
+    без лишнего запроса к API.
+    Своего глобального лимита здесь нет: запрос сначала встаёт в очередь своего чата
+    (ChatSchedulerMiddleware) и только потом занимает один из UPDATE_CONCURRENCY слотов.
+    Общий семафор до очереди чата позволил бы хвосту одного чата занять все слоты.
+    Число одновременных запросов от Telegram ограничивает max_connections в set_webhook.
+    """
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, **kwargs):
+        super().__init__(dispatcher=dispatcher, bot=bot, handle_in_background=False, **kwargs)
+        self.inflight = 0
+
+    async def _handle_request(self, bot: Bot, request: web.Request) -> web.Response:
+        metric_inc("webhook_requests")
+        self.inflight += 1
+        metric_set("webhook_inflight", self.inflight)
+        metric_max("webhook_inflight_max", self.inflight)
+        try:
+            return await super()._handle_request(bot, request)
+        finally:
+            self.inflight -= 1
+            metric_set("webhook_inflight", self.inflight)
+
+
+async def run_webhook():
+    """
+    Режим вебхука. Локально можно проверить без Telegram, отправив записанный апдейт
+    (с WEBHOOK_HOST=127.0.0.1 секрет не обязателен):
+
+        curl -X POST http://127.0.0.1:8080/webhook \\
+             -H "X-Telegram-Bot-Api-Secret-Token: $WEBHOOK_SECRET" \\
+             -H "Content-Type: application/json" -d @update.json
+    """
+    app = web.Application()
+    # shutdown-хуки бота должны отработать раньше, чем хэндлер закроет сессию
+    setup_application(app, dp, bot=bot)
+    WebhookRequestHandler(
+        dp,
+        bot,
+        secret_token=WEBHOOK_SECRET or None
+    ).register(app, path=WEBHOOK_PATH)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    logging.info(f"Webhook listening on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET or None,
+            allowed_updates=dp.resolve_used_update_types(),
+            max_connections=WEBHOOK_MAX_CONCURRENCY
+        )
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        with suppress(NotImplementedError):
+            loop.add_signal_handler(sig, stop.set)
+    try:
+        await stop.wait()
+    finally:
+        await runner.cleanup()
+
+
+def is_loopback_host(host: str) -> bool:
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
 async def main():
+    global _member_flush_task, _pending_sweep_task, _audit_task
+    if BOT_MODE == "webhook" and not WEBHOOK_SECRET and not is_loopback_host(WEBHOOK_HOST):
+        # без секрета любой, кто достучится до порта, шлёт боту поддельные апдейты (в том числе от OWNER_ID);
+        # вебхук мог быть зарегистрирован и снаружи, так что пустой WEBHOOK_URL не спасает
+        logging.error(
+            f"WEBHOOK_SECRET is required in webhook mode unless WEBHOOK_HOST is loopback "
+            f"(got {WEBHOOK_HOST}); refusing to start"
+        )
+        raise SystemExit(1)
     print(">>> Бот запущен!")
     await init_db()
-    await dp.start_polling(bot)
+    await rebuild_points_histograms()
+    await start_invalidation_listener()
+    _member_flush_task = asyncio.create_task(member_flush_loop())
+    _pending_sweep_task = asyncio.create_task(pending_sweep_loop())
+    _audit_task = asyncio.create_task(audit_loop())
+    if BOT_MODE == "webhook":
+        await run_webhook()
+    else:
+        await bot.delete_webhook()
+        await dp.start_polling(bot)
 
 
 if __name__ == "__main__":